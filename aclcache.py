@@ -0,0 +1,60 @@
+"""Cache of game membership checks (Game.user_moderating/user_playing).
+
+Two tiers: a per-request memo, reset by BaseRequestHandler at the start of
+every request, in front of memcache entries that expire after
+ACL_CACHE_SECONDS.  Handlers that change membership must call
+invalidate() for the affected (game, user).
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+MODERATOR = 'moderator'
+PLAYER = 'player'
+
+ACL_CACHE_SECONDS = 10*60
+
+_backend = memcache
+_request_memo = {}
+
+
+def use_backend(backend):
+   """Replaces memcache as the shared tier, e.g. with localcache.LocalCache"""
+   global _backend
+   _backend = backend
+
+def reset_request():
+   """Forgets everything memoized by the current request"""
+   _request_memo.clear()
+
+def _cache_key(kind, game, user):
+   if isinstance(game, db.Model):
+      game = game.key()
+   return 'aclkey:%s:%s:%s' % (kind, game, user.email())
+
+def member_key(kind, game, user, lookup):
+   """Returns the key of user's 'kind' membership entity in game, or None
+
+   lookup is called (and should query the datastore for the membership
+   entity or its key) only when neither tier knows the answer.
+   """
+   key = _cache_key(kind, game, user)
+   if key in _request_memo:
+      value = _request_memo[key]
+   else:
+      value = _backend.get(key)
+      if value is None:
+         member = lookup()
+         if isinstance(member, db.Model):
+            member = member.key()
+         value = member and str(member) or ''
+         _backend.set(key, value, ACL_CACHE_SECONDS)
+      _request_memo[key] = value
+   return value and db.Key(value) or None
+
+def invalidate(kind, game, user):
+   """Drops the cached answer for user's 'kind' membership of game"""
+   key = _cache_key(kind, game, user)
+   _request_memo.pop(key, None)
+   _backend.delete(key)
@@ -0,0 +1,30 @@
+"""Administrator pages (/admin/stats).
+
+app.yaml restricts these to administrators and routes them here ahead of
+the SDK's own /admin/ console.
+"""
+
+from handlers import BaseRequestHandler
+import instrument
+
+
+class StatsPage(BaseRequestHandler):
+   """ url: /admin/stats
+
+         Per-handler request costs and the slow request log of this instance
+
+         Template variables:
+            summary (instrument.summary())
+            slow_requests (newest first)
+            window_size, slow_request_ms
+   """
+   def get(self):
+      slow_requests = instrument.slow_log[:]
+      slow_requests.reverse()
+      self.generate('stats.html', {
+         'summary': instrument.summary(),
+         'slow_requests': slow_requests,
+         'window_requests': len(instrument.window),
+         'window_size': instrument.WINDOW_SIZE,
+         'slow_request_ms': instrument.SLOW_REQUEST_MS,
+         })
@@ -0,0 +1,198 @@
+"""Compact per-stage alive state.
+
+Every GamePlayer gets a seat number (GamePlayer.index) when joining, which
+never changes.  A Stage records its roster as Stage.seats, the number of
+seats taking part, and Stage.alive, a bitset with bit (seat % 8) of byte
+(seat // 8) set for every seat alive in that stage.  Starting a stage
+copies one small blob instead of writing a row per player, and "who was
+alive in stage N" is answered from the stage entity alone.
+
+Games created before seats existed are converted by migrate_stage() (see
+MigrateAliveStateTask), which folds their StageGamePlayer rows into the
+bitsets and then deletes them.
+"""
+
+from google.appengine.ext import db
+
+import tally
+from models import GamePlayer, Stage, StageGamePlayer, Vote
+from models import StageSnapshot, VoteGamePlayer
+
+
+def encode(seats):
+   """Returns the bitset blob for an iterable of seat numbers"""
+   data = []
+   for seat in seats:
+      byte = seat // 8
+      if byte >= len(data):
+         data.extend([0] * (byte + 1 - len(data)))
+      data[byte] |= 1 << (seat % 8)
+   return db.Blob(''.join([chr(b) for b in data]))
+
+def decode(blob):
+   """Returns the set of seat numbers in a bitset blob"""
+   seats = set()
+   for byte, value in enumerate(blob or ''):
+      for bit in range(8):
+         if ord(value) & (1 << bit):
+            seats.add(byte * 8 + bit)
+   return seats
+
+def alive_seats(stage):
+   """Returns the set of seats alive in stage"""
+   return decode(stage.alive)
+
+def is_alive(stage, seat):
+   """Returns true if the given seat is alive in stage"""
+   if seat is None or seat >= stage.seats:
+      return False
+   blob = stage.alive or ''
+   byte = seat // 8
+   return byte < len(blob) and bool(ord(blob[byte]) & (1 << (seat % 8)))
+
+def _update_seats(stage_key, alive, dead, replace):
+   stage = db.get(stage_key)
+   if replace:
+      seats = set()
+   else:
+      seats = alive_seats(stage)
+   seats.update(alive)
+   seats.difference_update(dead)
+   stage.alive = encode(seats)
+   stage.put()
+   return stage
+
+def update_seats(stage_key, alive=(), dead=()):
+   """Marks the given seats alive and/or dead in a stage, in a transaction
+
+   Returns the updated Stage.
+   """
+   return db.run_in_transaction(_update_seats, stage_key, alive, dead, False)
+
+def replace_seats(stage_key, alive):
+   """Makes exactly the given seats alive in a stage, in a transaction
+
+   Returns the updated Stage.
+   """
+   return db.run_in_transaction(_update_seats, stage_key, alive, (), True)
+
+def game_players(game):
+   """Returns the game's seated GamePlayers (game entity or key), by seat"""
+   players = {}
+   for player in GamePlayer.all().filter('game =', game):
+      if player.index is None:
+         continue
+      # while the game is re-keyed (rekey.py) a seat has two rows
+      if player.index not in players or player.key().parent():
+         players[player.index] = player
+   return [players[seat] for seat in sorted(players)]
+
+def player_entry(game_player):
+   """Returns the JSON-able {'key', 'seat', 'alias'} of a GamePlayer"""
+   return {
+      'key': str(game_player.key()),
+      'seat': game_player.index,
+      'alias': game_player.alias or game_player.user.nickname(),
+      }
+
+def roster(stage, players=None):
+   """Returns (alive, dead) lists of the GamePlayers taking part in stage
+
+   players: the game's GamePlayers, if the caller already has them.
+   """
+   if players is None:
+      players = game_players(Stage.game.get_value_for_datastore(stage))
+   seats = alive_seats(stage)
+   alive = []
+   dead = []
+   for player in players:
+      if player.index is None or player.index >= stage.seats:
+         continue
+      if player.index in seats:
+         alive.append(player)
+      else:
+         dead.append(player)
+   return alive, dead
+
+def _take_seats(game_key, count, user=None):
+   """Reserves count seats in a game (run in a transaction)
+
+   Also records user, if given, in Game.playerUsers.  Returns the first
+   reserved seat number.
+   """
+   game = db.get(game_key)
+   first = game.playerCount or 0
+   game.playerCount = first + count
+   if user and user not in game.playerUsers:
+      game.playerUsers.append(user)
+   game.put()
+   return first
+
+def _join(game_key, user, alias):
+   key = GamePlayer.key_for(game_key, user)
+   if db.get(key):
+      return None
+   player = GamePlayer(parent = game_key, key_name = key.name(), user = user,
+                       game = game_key, alias = alias,
+                       index = _take_seats(game_key, 1, user))
+   player.put()
+   return player
+
+def join(game_key, user, alias):
+   """Seats user in the game as a new GamePlayer
+
+   The player is a child of the game, so taking the seat and creating the
+   player is one transaction.  Returns the GamePlayer, or None if the user
+   had already joined.
+   """
+   return db.run_in_transaction(_join, game_key, user, alias)
+
+
+def migrate_stage(game_key, stage_index):
+   """Converts one stage of a pre-seat game to the bitset representation
+
+   Stage 0 also seats every unseated GamePlayer, in key order.  Votes are
+   recounted, so run it while the game is idle.  Returns the index of the
+   next stage to migrate, or None when the game is done.
+   """
+   if stage_index == 0:
+      unseated = [p for p in GamePlayer.all().filter('game =', game_key)
+                  .order('__key__') if p.index is None]
+      if unseated:
+         first = db.run_in_transaction(_take_seats, game_key, len(unseated))
+         for offset, player in enumerate(unseated):
+            player.index = first + offset
+         db.put(unseated)
+   
+   stage = Stage.all().filter('game =', game_key) \
+                .filter('index =', stage_index).get()
+   if not stage:
+      return None
+   
+   seat_of = dict([(p.key(), p.index) for p in game_players(game_key)])
+   rows = list(StageGamePlayer.all().filter('stage =', stage))
+   if rows:
+      player_of = dict([(row.key(), StageGamePlayer.player
+                                       .get_value_for_datastore(row))
+                        for row in rows])
+      stage.seats = max([seat_of.get(k, -1) for k in player_of.values()]) + 1
+      stage.alive = encode([seat_of[player_of[row.key()]] for row in rows
+                            if row.isAlive and
+                               player_of[row.key()] in seat_of])
+      stage.put()
+      
+      # votes chose StageGamePlayers; point them at the GamePlayer instead
+      for vote in Vote.all().filter('stage =', stage):
+         choices = list(vote.choices)
+         for choice in choices:
+            old = VoteGamePlayer.choice.get_value_for_datastore(choice)
+            if old in player_of:
+               choice.choice = player_of[old]
+         db.put(choices)
+         tally.rebuild(vote, choices)
+      
+      db.delete(rows)
+      # the roster changed; the next read rebuilds the snapshot
+      db.delete(db.Key.from_path(StageSnapshot.kind(), str(stage.key())))
+   
+   return stage_index + 1
@@ -0,0 +1,177 @@
+"""Cold storage for archived games.
+
+An archived game never changes again, so compact() serializes its whole
+history (players, stages with their alive seats, votes with their outcome,
+winner, final counts and every choice) into one compressed GameArchive
+entity and then deletes the Stage, Vote, VoteGamePlayer, VoteTallyShard,
+VoteResult, StageSnapshot, QueuedCast and CastFoldLease rows it came from,
+one stage per step (see CompactGameTask).  The Game, GamePlayer and
+GameModerator rows stay, so the dashboard and access checks still work.
+
+load() reads the history back, expanded for rendering by HistoryPage.
+Legacy StageGamePlayer rosters are migrated (alivestate.migrate_stage)
+before the archive is written, one stage per step as well.
+"""
+
+from google.appengine.ext import db
+from django.utils import simplejson
+import zlib
+
+import alivestate
+import castqueue
+import tally
+from models import CastFoldLease, GameArchive, GamePlayer, QueuedCast
+from models import Stage, StageGamePlayer, Vote, VoteGamePlayer, VoteResult
+
+
+# Bump whenever the layout of the archived history changes.  Schema 1
+# archives have no outcome, winner or counts per vote.
+ARCHIVE_SCHEMA = 2
+
+
+def serialize(game):
+   """Returns the full history of a game as a JSON-able dict"""
+   players = alivestate.game_players(game)
+   seat_of = dict([(p.key(), p.index) for p in players])
+   
+   stages = []
+   for stage in Stage.all().filter('game =', game).order('index'):
+      stage_votes = list(Vote.all().filter('stage =', stage).order('index'))
+      results = db.get([VoteResult.key_for(vote) for vote in stage_votes])
+      votes = []
+      for vote, result in zip(stage_votes, results):
+         # closed votes count from their frozen results
+         if result:
+            counts = [(db.Key(k), n)
+                      for k, n in result.result()['counts'].items()]
+         else:
+            counts = tally.get_counts(vote).items()
+         choices = []
+         for choice in vote.choices:
+            voter = VoteGamePlayer.player.get_value_for_datastore(choice)
+            chosen = VoteGamePlayer.choice.get_value_for_datastore(choice)
+            choices.append([seat_of.get(voter), seat_of.get(chosen)])
+         votes.append({
+            'index': vote.index,
+            'name': vote.name,
+            'created': vote.created.isoformat(),
+            'outcome': vote.outcome,
+            'winner': seat_of.get(Vote.winner.get_value_for_datastore(vote)),
+            'counts': sorted([[seat_of[k], n] for k, n in counts
+                              if k in seat_of]),
+            'choices': choices,
+            })
+      stages.append({
+         'index': stage.index,
+         'isDay': stage.isDay,
+         'seats': stage.seats,
+         'alive': sorted(alivestate.alive_seats(stage)),
+         'votes': votes,
+         })
+   
+   return {
+      'name': game.name,
+      'created': game.created.isoformat(),
+      'players': [{'seat': p.index,
+                   'alias': p.alias or p.user.nickname()} for p in players],
+      'stages': stages,
+      }
+
+def write(game):
+   """Stores the game's history in its GameArchive (replacing any)"""
+   archive = GameArchive(key_name = str(game.key()),
+                         schema = ARCHIVE_SCHEMA,
+                         data = db.Blob(zlib.compress(
+                            simplejson.dumps(serialize(game)), 9)))
+   archive.put()
+   return archive
+
+def delete_stage(stage):
+   """Deletes a stage and everything hanging off it"""
+   keys = [stage.key(), db.Key.from_path('StageSnapshot', str(stage.key()))]
+   for vote in Vote.all().filter('stage =', stage):
+      keys.extend(VoteGamePlayer.all(keys_only=True).filter('vote =', vote))
+      for root in castqueue.log_roots(vote.key()):
+         keys.extend(QueuedCast.all(keys_only=True).ancestor(root))
+      keys.append(CastFoldLease.key_for(vote))
+      keys.extend(tally.shard_keys(vote))
+      keys.append(VoteResult.key_for(vote))
+      keys.append(vote.key())
+   db.delete(keys)
+
+def _migrate_step(game_key):
+   """Migrates the game's first stage still on StageGamePlayer rows
+
+   Returns false if there is none left.  Unseated players are seated by
+   migrating stage 0 first, as later stages need their seats.
+   """
+   if [p for p in GamePlayer.all().filter('game =', game_key)
+       if p.index is None]:
+      alivestate.migrate_stage(game_key, 0)
+      return True
+   stages = list(Stage.all().filter('game =', game_key))
+   stages.sort(key=lambda stage: stage.index)
+   for stage in stages:
+      if StageGamePlayer.all(keys_only=True).filter('stage =', stage).get():
+         alivestate.migrate_stage(game_key, stage.index)
+         return True
+   return False
+
+def compact(game_key):
+   """Runs one step of compacting an archived game
+
+   The first steps migrate any legacy stage rosters, one stage each; the
+   next writes the archive and detaches the current stage; each following
+   step deletes one stage.  Returns true while steps remain.
+   """
+   game = db.get(game_key)
+   if not game or not game.archived:
+      return False
+   if not GameArchive.get_by_key_name(str(game_key)):
+      if _migrate_step(game_key):
+         return True
+      write(game)
+      game.currentStage = None
+      game.put()
+      return True
+   stage = Stage.all().filter('game =', game_key).get()
+   if not stage:
+      return False
+   delete_stage(stage)
+   return True
+
+def history(game):
+   """Returns the game's history in the layout of serialize()
+
+   Read from its GameArchive once compacted, built from the live rows
+   before that.
+   """
+   archive = GameArchive.get_by_key_name(str(game.key()))
+   if archive:
+      return archive.history()
+   return serialize(game)
+
+def load(game):
+   """Returns the archived history of a game, or None if not compacted
+
+   Seats are expanded to player dicts ({'seat', 'alias'}) for rendering,
+   and each vote's counts to [{'player', 'votes'}].
+   """
+   archive = GameArchive.get_by_key_name(str(game.key()))
+   if not archive:
+      return None
+   history = archive.history()
+   players = dict([(p['seat'], p) for p in history['players']])
+   for stage in history['stages']:
+      alive = set(stage['alive'])
+      stage['alive'] = [players[s] for s in sorted(alive) if s in players]
+      stage['dead'] = [players[s] for s in range(stage['seats'])
+                       if s not in alive and s in players]
+      for vote in stage['votes']:
+         vote['winner'] = players.get(vote.get('winner'))
+         vote['counts'] = [{'player': players.get(seat), 'votes': votes}
+                           for seat, votes in vote.get('counts', [])]
+         vote['choices'] = [{'voter': players.get(voter),
+                             'choice': players.get(choice)}
+                            for voter, choice in vote['choices']]
+   return history
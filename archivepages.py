@@ -0,0 +1,142 @@
+"""Archive, history and export pages (/archivegame.do, /history,
+/analytics, /export).
+
+Imported lazily by votelynch.py: only moderators winding up or reviewing a
+game need these, and with them archive.py and export.py.
+"""
+
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext.webapp.util import login_required
+from django.utils import simplejson
+
+import archive
+import changes
+import export
+import resolution
+from handlers import BaseRequestHandler, action_login_required, rate_limited
+from models import Game
+
+
+class ArchiveGameAction(BaseRequestHandler):
+   """ url: /archivegame.do?game=<gameid>
+
+         Marks a finished game archived and queues moving its history into
+         cold storage (see archive.py)
+   """
+   @action_login_required
+   @rate_limited
+   def post(self):
+      game = Game.get(self.request.get('game'))
+      
+      if not game:
+         self.error(403)
+         return
+      
+      if not game.current_user_moderating():
+         self.error(403)
+         return
+      
+      if not self.admit_game(game.key()):
+         return
+      
+      if not game.archived:
+         game.archived = True
+         game.put()
+         changes.bump(game)
+         taskqueue.add(url='/tasks/compactgame',
+                       params={'game': str(game.key())})
+      
+      if self.request.get('next'):
+         self.redirect(self.request.get('next'))
+      else:
+         self.redirect('/managegame?game=' + str(game.key()))
+
+class HistoryPage(BaseRequestHandler):
+   """ url: /history?game=<gameid>
+
+         Full history of an archived game, read from its GameArchive
+
+         Template variables:
+            game
+            history (players, stages with alive/dead and votes with choices;
+                     None while the game is still being compacted)
+   """
+   @login_required
+   def get(self):
+      game = Game.get(self.request.get('game'))
+      
+      if not game:
+         self.error(403)
+         return
+      
+      if not game.current_user_playing() and \
+            not game.current_user_moderating():
+         self.error(403)
+         return
+      
+      self.generate('history.html', {
+         'game': game,
+         'history': archive.load(game),
+         })
+
+class AnalyticsPage(BaseRequestHandler):
+   """ url: /analytics?game=<gameid>
+
+         Voting statistics over the whole game, for moderators
+
+         Response (JSON): resolution.analyze() of the game's history
+   """
+   @login_required
+   def get(self):
+      game = Game.get(self.request.get('game'))
+      
+      if not game:
+         self.error(403)
+         return
+      
+      if not game.current_user_moderating():
+         self.error(403)
+         return
+      
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(simplejson.dumps(
+         resolution.analyze(archive.history(game))))
+
+class ExportPage(BaseRequestHandler):
+   """ url: /export?game=<gameid>[&format=ndjson|csv][&start=<stage index>]
+
+         The game's history as NDJSON (default) or CSV, for moderators.
+         Long games come in parts: a part ending in a 'next' record is
+         continued by requesting again with start set to its stage.
+   """
+   @login_required
+   def get(self):
+      game = Game.get(self.request.get('game'))
+      
+      if not game:
+         self.error(403)
+         return
+      
+      if not game.current_user_moderating():
+         self.error(403)
+         return
+      
+      format = self.request.get('format', 'ndjson')
+      try:
+         start = int(self.request.get('start', 0))
+      except ValueError:
+         start = 0
+      records = export.records(game, start)
+      
+      filename = 'game-%s' % game.key().id_or_name()
+      if format == 'csv':
+         self.response.headers['Content-Type'] = 'text/csv'
+         self.response.headers['Content-Disposition'] = \
+            'attachment; filename=%s.csv' % filename
+         export.write_csv(records, self.response.out)
+      else:
+         self.response.headers['Content-Type'] = 'application/x-ndjson'
+         self.response.headers['Content-Disposition'] = \
+            'attachment; filename=%s.ndjson' % filename
+         for line in export.ndjson_lines(records):
+            self.response.out.write(line)
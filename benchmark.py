@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#
+# Load test and benchmark harness for VoteLynch.
+#
+# Drives the real votelynch WSGI application, in process, against the App
+# Engine SDK's in-memory service stubs through a whole game:
+#
+#   create game -> N players join -> create stage -> create vote ->
+#   cast storm (every player casts and changes their vote several times,
+#   in random order) -> play/vote page views -> close vote
+#
+# and reports, for every route, p50/p95/p99 latency plus datastore RPCs,
+# entity reads and entity writes per request, as JSON.
+#
+# Requests run one at a time: the python runtime serves one request per
+# instance at a time, and the SDK takes the signed in user from
+# os.environ.  The cast storm therefore measures the per-request cost of
+# a close-of-vote surge rather than real concurrency.
+#
+# Usage:
+#   python benchmark.py --sdk ~/google_appengine [--players 50]
+#                       [--rounds 3] [--seed 1] [--output bench.json]
+#
+
+import optparse
+import os
+import random
+import sys
+import time
+import urllib
+from StringIO import StringIO
+
+
+APP_ID = 'votelynch'
+PASSWORD = 'benchmark'
+MODERATOR = 'moderator@example.com'
+
+
+def setup_sdk(sdk_path):
+   """Puts the SDK on sys.path and registers in-memory service stubs"""
+   if sdk_path:
+      sys.path.insert(0, sdk_path)
+      import dev_appserver
+      dev_appserver.fix_sys_path()
+
+   from google.appengine.api import apiproxy_stub_map
+   from google.appengine.api import datastore_file_stub
+   from google.appengine.api import user_service_stub
+   from google.appengine.api.labs.taskqueue import taskqueue_stub
+   from google.appengine.api.memcache import memcache_stub
+
+   os.environ['APPLICATION_ID'] = APP_ID
+   os.environ['AUTH_DOMAIN'] = 'example.com'
+   os.environ['SERVER_NAME'] = 'localhost'
+   os.environ['SERVER_PORT'] = '8080'
+   os.environ['SERVER_SOFTWARE'] = 'Development/benchmark'
+
+   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+   apiproxy = apiproxy_stub_map.apiproxy
+   apiproxy.RegisterStub('datastore_v3',
+      datastore_file_stub.DatastoreFileStub(APP_ID, '/dev/null', '/dev/null'))
+   apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+   apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+   apiproxy.RegisterStub('taskqueue', taskqueue_stub.TaskQueueServiceStub(
+      root_path=os.path.dirname(os.path.abspath(__file__))))
+   apiproxy.GetPostCallHooks().Append('benchmark', _count_rpc, 'datastore_v3')
+
+
+# Datastore activity of the request in progress
+_counters = {'rpcs': 0, 'reads': 0, 'writes': 0}
+
+def _count_rpc(service, call, request, response):
+   _counters['rpcs'] += 1
+   if call == 'Get':
+      _counters['reads'] += len([e for e in response.entity_list()
+                                 if e.has_entity()])
+   elif call in ('RunQuery', 'Next'):
+      _counters['reads'] += response.result_size()
+   elif call == 'Put':
+      _counters['writes'] += request.entity_size()
+   elif call == 'Delete':
+      _counters['writes'] += request.key_size()
+
+
+class Response(object):
+   def __init__(self, status, headers, body):
+      self.status = status
+      self.headers = headers
+      self.body = body
+
+   def location(self):
+      """Returns the value of the query string of a redirect"""
+      location = self.headers.get('Location', '')
+      return urllib.unquote(location.split('=', 1)[-1])
+
+
+class RouteStats(object):
+   """Latencies and datastore activity of every request to one route"""
+
+   def __init__(self):
+      self.latencies = []
+      self.rpcs = []
+      self.reads = []
+      self.writes = []
+      self.errors = 0
+
+   def add(self, seconds, counters, status):
+      self.latencies.append(seconds * 1000)
+      self.rpcs.append(counters['rpcs'])
+      self.reads.append(counters['reads'])
+      self.writes.append(counters['writes'])
+      if status >= 400:
+         self.errors += 1
+
+   def report(self):
+      count = len(self.latencies)
+      return {
+         'requests': count,
+         'errors': self.errors,
+         'p50_ms': percentile(self.latencies, 50),
+         'p95_ms': percentile(self.latencies, 95),
+         'p99_ms': percentile(self.latencies, 99),
+         'rpcs_per_request': float(sum(self.rpcs)) / count,
+         'reads_per_request': float(sum(self.reads)) / count,
+         'writes_per_request': float(sum(self.writes)) / count,
+         'max_rpcs': max(self.rpcs),
+         }
+
+def percentile(values, pct):
+   """Nearest-rank percentile of a list of numbers"""
+   ordered = sorted(values)
+   rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+   return round(ordered[min(rank, len(ordered) - 1)], 3)
+
+
+class Client(object):
+   """Sends requests straight to the WSGI application, recording stats"""
+
+   def __init__(self, application):
+      self.application = application
+      self.stats = {}
+
+   def request(self, method, path, params, user, admin=False):
+      body = urllib.urlencode(params)
+      environ = {
+         'REQUEST_METHOD': method,
+         'SCRIPT_NAME': '',
+         'PATH_INFO': path,
+         'QUERY_STRING': method == 'GET' and body or '',
+         'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+         'CONTENT_LENGTH': method == 'POST' and str(len(body)) or '0',
+         'SERVER_NAME': 'localhost',
+         'SERVER_PORT': '8080',
+         'HTTP_HOST': 'localhost:8080',
+         'wsgi.version': (1, 0),
+         'wsgi.url_scheme': 'http',
+         'wsgi.input': StringIO(method == 'POST' and body or ''),
+         'wsgi.errors': sys.stderr,
+         'wsgi.multithread': False,
+         'wsgi.multiprocess': False,
+         'wsgi.run_once': False,
+         }
+      os.environ['USER_EMAIL'] = user or ''
+      os.environ['USER_IS_ADMIN'] = admin and '1' or '0'
+
+      result = {}
+      def start_response(status, headers, exc_info=None):
+         result['status'] = int(status.split()[0])
+         result['headers'] = dict(headers)
+
+      for key in _counters:
+         _counters[key] = 0
+      start = time.time()
+      body = ''.join(self.application(environ, start_response))
+      elapsed = time.time() - start
+
+      self.stats.setdefault(path, RouteStats()).add(
+         elapsed, _counters, result['status'])
+      return Response(result['status'], result['headers'], body)
+
+   def run_tasks(self):
+      """Runs every queued task (and the tasks those queue) as admin"""
+      from google.appengine.api import apiproxy_stub_map
+      import base64
+      stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+      while True:
+         tasks = stub.GetTasks('default')
+         if not tasks:
+            return
+         for task in tasks:
+            stub.DeleteTask('default', task['name'])
+            params = dict([p.split('=', 1) for p in
+                           base64.b64decode(task['body']).split('&') if p])
+            params = dict([(k, urllib.unquote_plus(v))
+                           for k, v in params.items()])
+            self.request('POST', task['url'], params, MODERATOR, admin=True)
+
+
+def run_game(client, players, rounds, rng):
+   """Plays one scripted game through the client"""
+   from google.appengine.ext import db
+   from models import GamePlayer
+
+   response = client.request('POST', '/creategame.do',
+                             {'name': 'Benchmark', 'password': PASSWORD},
+                             MODERATOR)
+   game = response.location()
+
+   emails = ['player%d@example.com' % i for i in range(players)]
+   for i, email in enumerate(emails):
+      client.request('POST', '/joingame.do',
+                     {'game': game, 'alias': 'Player %d' % i,
+                      'password': PASSWORD}, email)
+
+   response = client.request('POST', '/createstage.do', {'game': game},
+                             MODERATOR)
+   stage = response.location()
+   client.run_tasks()
+
+   response = client.request('POST', '/createvote.do', {'game': game},
+                             MODERATOR)
+   vote = response.location()
+
+   candidates = [str(k) for k in GamePlayer.all(keys_only=True)
+                 .filter('game =', db.Key(game))]
+
+   # the storm: everyone casts, then keeps changing their mind
+   for _ in range(rounds):
+      order = emails[:]
+      rng.shuffle(order)
+      for email in order:
+         client.request('POST', '/castvote.do',
+                        {'vote': vote, 'choice': rng.choice(candidates)},
+                        email)
+      for email in rng.sample(emails, min(len(emails), 10)):
+         client.request('GET', '/play', {'game': game}, email)
+         client.request('GET', '/vote', {'vote': vote}, email)
+
+   client.request('POST', '/closevote.do', {'vote': vote}, MODERATOR)
+   client.request('GET', '/', {}, MODERATOR)
+   client.run_tasks()
+
+
+def main():
+   parser = optparse.OptionParser()
+   parser.add_option('--sdk', help='path to the App Engine SDK')
+   parser.add_option('--players', type='int', default=50)
+   parser.add_option('--rounds', type='int', default=3,
+                     help='times each player casts during the storm')
+   parser.add_option('--seed', type='int', default=1)
+   parser.add_option('--output', help='write the JSON report here')
+   parser.add_option('--rate-limits', action='store_true',
+                     help='keep the action rate limits (a big storm trips '
+                          'the per-game limits)')
+   options, args = parser.parse_args()
+
+   setup_sdk(options.sdk)
+   sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+   import votelynch
+   import ratelimit
+   from django.utils import simplejson
+
+   if not options.rate_limits:
+      unlimited = (1e9, 1e9)
+      ratelimit.LIMITS.clear()
+      ratelimit.DEFAULT_LIMITS = (unlimited, unlimited)
+
+   client = Client(votelynch.application)
+   start = time.time()
+   run_game(client, options.players, options.rounds,
+            random.Random(options.seed))
+
+   report = {
+      'config': {'players': options.players, 'rounds': options.rounds,
+                 'seed': options.seed},
+      'elapsed_s': round(time.time() - start, 3),
+      'routes': dict([(path, stats.report())
+                      for path, stats in client.stats.items()]),
+      }
+   output = simplejson.dumps(report, indent=2, sort_keys=True)
+   if options.output:
+      open(options.output, 'w').write(output + '\n')
+   else:
+      sys.stdout.write(output + '\n')
+
+if __name__ == '__main__':
+   main()
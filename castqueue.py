@@ -0,0 +1,280 @@
+"""Write-behind ingestion of casts (CastVoteAction with QUEUE_CASTS).
+
+A validated cast is appended to a per-vote log and acknowledged at once;
+the player does not wait on their VoteGamePlayer row or the tally.  A
+/tasks/foldcasts task, queued at most once per FOLD_DELAY_SECONDS per
+vote, folds the log into the stored choices in batches (fold()): the last
+cast of each player wins, and a batch costs one batch get and put of
+VoteGamePlayer rows and one tally shard transaction.
+
+Casts are numbered from a per-vote counter in memcache (seeded from the
+clock in microseconds, so a counter memcache forgot comes back larger).
+Each VoteGamePlayer remembers the number of the last cast folded into it
+(VoteGamePlayer.sequence), and fold() skips casts at or below it, so a
+cast that commits after a newer one of the same player never overwrites
+it and a batch folded twice changes nothing the second time.
+
+Only one fold of a vote runs at a time: fold() first takes the vote's
+lease (a CastFoldLease in the vote's entity group, claimed in a
+transaction) and gives up if another fold holds it.  A lease left behind
+by a fold that died expires after LEASE_SECONDS.  That fold may have put
+its VoteGamePlayer rows but not moved the tally, and its casts are then
+skipped by sequence, so the fold that takes the lease over first recounts
+the tally from the stored rows (_recount()).
+
+Each fold bumps the vote's and game's versions (changes.bump) so pages
+polling /changes pick up the folded casts.
+
+CloseVoteAction drains the log (drain()) after closing the vote and before
+resolving it, waiting out a fold in progress.  A cast accepted just as the
+vote closed can still arrive after the drain; once the vote is resolved,
+fold() leaves such casts in the log, to be folded if the vote is reopened.
+Casts are only ever taken off the log once folded.
+
+The log lives in the datastore (DatastoreLog): one QueuedCast entity per
+cast, a child of one of LOG_SHARDS log roots per vote so a surge of casts
+is spread over several entity groups, and read with ancestor queries,
+which always see every committed cast.  LocalQueue is an in-process
+stand-in, see use_backend().  A player's latest cast is also kept in
+memcache so their own vote page shows it before it is folded
+(pending_choice()).
+"""
+
+import datetime
+import random
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+
+import alivestate
+import changes
+import resolution
+import tally
+from models import CastFoldLease, QueuedCast, Stage, VoteGamePlayer
+
+
+# Casts folded per batch
+FOLD_BATCH = 100
+
+# How long casts collect before a fold task runs
+FOLD_DELAY_SECONDS = 2
+
+# How long a player's unfolded cast is remembered for their vote page
+PENDING_SECONDS = 10*60
+
+# Entity groups a vote's log is spread over; a player's casts all go to
+# the same one
+LOG_SHARDS = 5
+
+# How long a fold may hold a vote's lease, and how often drain() retries
+# while another fold holds it
+LEASE_SECONDS = 10
+LEASE_RETRY_SECONDS = 0.2
+
+
+def _log_root(vote_key, shard):
+   """Returns the key of one of a vote's log roots (never stored itself)"""
+   return db.Key.from_path('QueuedCastLog', '%s:%d' % (vote_key, shard))
+
+def log_roots(vote_key):
+   """Returns the keys of every log root of a vote"""
+   return [_log_root(vote_key, shard) for shard in range(LOG_SHARDS)]
+
+class DatastoreLog(object):
+   """The cast log as QueuedCast entities"""
+
+   def append(self, vote_key, cast):
+      sequence, user, player_key, choice_key = cast
+      shard = (zlib.crc32(user.email()) & 0xffffffff) % LOG_SHARDS
+      QueuedCast(parent = _log_root(vote_key, shard), vote = vote_key,
+                 user = user, player = player_key, choice = choice_key,
+                 sequence = sequence).put()
+
+   def peek(self, vote_key, limit):
+      """Returns up to limit (id, cast) pairs, oldest first"""
+      entries = []
+      for root in log_roots(vote_key):
+         entries.extend(QueuedCast.all().ancestor(root)
+                                  .order('sequence').fetch(limit))
+      entries.sort(key=lambda entry: entry.sequence)
+      return [(entry.key(),
+               (entry.sequence, entry.user,
+                QueuedCast.player.get_value_for_datastore(entry),
+                QueuedCast.choice.get_value_for_datastore(entry)))
+              for entry in entries[:limit]]
+
+   def remove(self, vote_key, ids):
+      db.delete(ids)
+
+class LocalQueue(object):
+   """An in-process cast log with the same interface as DatastoreLog"""
+
+   def __init__(self):
+      self._casts = {}    # vote key -> [(id, cast)], oldest first
+      self._next_id = 0
+
+   def append(self, vote_key, cast):
+      self._next_id += 1
+      entries = self._casts.setdefault(str(vote_key), [])
+      entries.append((self._next_id, cast))
+      entries.sort(key=lambda entry: entry[1][0])
+
+   def peek(self, vote_key, limit):
+      return self._casts.get(str(vote_key), [])[:limit]
+
+   def remove(self, vote_key, ids):
+      ids = set(ids)
+      self._casts[str(vote_key)] = [entry for entry in
+                                    self._casts.get(str(vote_key), [])
+                                    if entry[0] not in ids]
+
+_backend = DatastoreLog()
+
+
+def use_backend(backend):
+   """Replaces the datastore log, e.g. with LocalQueue()"""
+   global _backend
+   _backend = backend
+
+def _pending_key(vote_key, user):
+   return 'pendingcast:%s/%s' % (vote_key, user.email())
+
+def _next_sequence(vote_key):
+   """Returns the number of a new cast in a vote"""
+   key = 'castsequence:%s' % vote_key
+   sequence = memcache.incr(key)
+   if sequence is None:
+      memcache.add(key, int(time.time() * 1000000))
+      sequence = memcache.incr(key)
+   if sequence is None:
+      # memcache is unavailable; the clock still orders most casts
+      sequence = int(time.time() * 1000000)
+   return sequence
+
+def _schedule(vote_key):
+   """Queues a fold of the vote unless one is already due"""
+   window = int(time.time() / FOLD_DELAY_SECONDS)
+   if memcache.add('castfold:%s:%d' % (vote_key, window), 1,
+                   FOLD_DELAY_SECONDS * 2):
+      taskqueue.add(url='/tasks/foldcasts', params={'vote': str(vote_key)},
+                    countdown=FOLD_DELAY_SECONDS)
+
+def append(vote_key, user, player_key, choice_key):
+   """Logs a validated cast of user (player_key) for choice_key"""
+   _backend.append(vote_key, (_next_sequence(vote_key), user, player_key,
+                              choice_key))
+   memcache.set(_pending_key(vote_key, user), str(choice_key),
+                PENDING_SECONDS)
+   _schedule(vote_key)
+
+def pending_choice(vote_key, user):
+   """Returns the key of user's latest queued choice in vote, if known"""
+   choice = memcache.get(_pending_key(vote_key, user))
+   return choice and db.Key(choice)
+
+
+def _acquire(vote_key, owner):
+   """Takes the vote's fold lease for owner (run in a transaction)
+
+   Returns None if another owner holds an unexpired lease, otherwise
+   whether it took over an expired lease left behind by a fold that died.
+   """
+   key = CastFoldLease.key_for(vote_key)
+   lease = db.get(key)
+   now = datetime.datetime.now()
+   if lease and lease.owner != owner and lease.expires > now:
+      return None
+   CastFoldLease(parent = vote_key, key_name = key.name(), owner = owner,
+                 expires = now + datetime.timedelta(seconds=LEASE_SECONDS)
+                 ).put()
+   return bool(lease and lease.owner != owner)
+
+def _release(vote_key, owner):
+   """Gives the vote's fold lease back (run in a transaction)"""
+   lease = db.get(CastFoldLease.key_for(vote_key))
+   if lease and lease.owner == owner:
+      lease.delete()
+
+def _recount(vote_key):
+   """Recounts an open vote's tally from its stored choices
+
+   Casts go through the log while QUEUE_CASTS is on, so with the lease
+   held nothing else moves the tally and the recount loses no cast.
+   """
+   vote = db.get(vote_key)
+   if not vote or vote.resolved:
+      return
+   game_key = Stage.game.get_value_for_datastore(vote.stage)
+   tally.rebuild(vote, resolution.stored_rows(
+      vote, alivestate.game_players(game_key)))
+
+def _fold(vote_key, limit):
+   entries = _backend.peek(vote_key, limit)
+   if not entries:
+      return 0
+
+   vote = db.get(vote_key)
+   if not vote or vote.resolved:
+      # left for a reopened vote (or archive.delete_stage)
+      return 0
+
+   latest = {}     # email -> (sequence, user, player key, choice key)
+   for id, cast in entries:
+      latest[cast[1].email()] = cast
+   casts = latest.values()
+   rows = db.get([VoteGamePlayer.key_for(vote_key, user)
+                  for sequence, user, player_key, choice_key in casts])
+   changed = []
+   moves = []
+   for row, (sequence, user, player_key, choice_key) in zip(rows, casts):
+      if row and (row.sequence or 0) >= sequence:
+         # already folded, or older than the cast that was
+         continue
+      if row:
+         old_choice = VoteGamePlayer.choice.get_value_for_datastore(row)
+      else:
+         row = VoteGamePlayer(
+            key_name = VoteGamePlayer.key_name_for(vote_key, user),
+            vote = vote_key,
+            player = player_key)
+         old_choice = None
+      row.choice = choice_key
+      row.sequence = sequence
+      changed.append(row)
+      moves.append((old_choice, choice_key))
+   db.put(changed)
+   tally.move_votes(vote_key, moves)
+   if changed:
+      changes.bump(vote_key, Stage.game.get_value_for_datastore(vote.stage))
+
+   _backend.remove(vote_key, [id for id, cast in entries])
+   return len(entries)
+
+def fold(vote_key, limit=FOLD_BATCH):
+   """Folds the oldest limit queued casts of a vote
+
+   Returns how many casts it took off the log, or None if another fold of
+   the vote is in progress.
+   """
+   owner = '%016x' % random.getrandbits(64)
+   took_over = db.run_in_transaction(_acquire, vote_key, owner)
+   if took_over is None:
+      return None
+   try:
+      if took_over:
+         _recount(vote_key)
+      return _fold(vote_key, limit)
+   finally:
+      db.run_in_transaction(_release, vote_key, owner)
+
+def drain(vote_key):
+   """Folds every queued cast of a vote, waiting out a fold in progress"""
+   while True:
+      folded = fold(vote_key)
+      if folded is None:
+         time.sleep(LEASE_RETRY_SECONDS)
+      elif not folded:
+         return
@@ -0,0 +1,80 @@
+"""Change versions for live game and vote pages.
+
+Every game and vote has a version number in memcache that state-changing
+handlers bump (bump()).  Pages embed the version they were rendered at and
+poll /changes every RETRY_SECONDS until it moves, so clients only fetch
+data when something actually changed.  A poll is answered at once: the
+python runtime serves one request per instance at a time, so holding
+polls open would pin an instance per few clients.
+
+Versions are seeded from the clock in milliseconds, so if memcache evicts
+one it comes back larger than any value a client can have seen.
+
+Next to each version memcache also keeps the time of the last change
+(last_changed()), which conditional GET (conditional.py) sends as
+Last-Modified.  A forgotten time also comes back as "now".
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+# How long a client waits before polling /changes again after "no change"
+RETRY_SECONDS = 5
+
+_backend = memcache
+
+
+def use_backend(backend):
+   """Replaces memcache, e.g. with localcache.LocalCache"""
+   global _backend
+   _backend = backend
+
+def _cache_key(entity):
+   if isinstance(entity, db.Model):
+      entity = entity.key()
+   return 'changes:%s' % entity
+
+def _time_key(entity):
+   return 'changed:' + _cache_key(entity)
+
+def _seed():
+   return int(time.time() * 1000)
+
+def current(entity):
+   """Returns the current version of a game or vote (entity or key)"""
+   key = _cache_key(entity)
+   version = _backend.get(key)
+   if version is None:
+      if _backend.add(key, _seed()):
+         _backend.set(_time_key(entity), time.time())
+      version = _backend.get(key)
+   return version
+
+def bump(*entities):
+   """Marks the given games and/or votes as changed"""
+   for entity in entities:
+      key = _cache_key(entity)
+      if _backend.incr(key) is None:
+         _backend.add(key, _seed())
+      _backend.set(_time_key(entity), time.time())
+
+def token(*entities):
+   """Returns one version string covering all the given games/votes"""
+   return '-'.join([str(current(e)) for e in entities if e])
+
+def last_changed(*entities):
+   """Returns the time (in seconds) of the latest change to any entity"""
+   latest = 0
+   for entity in entities:
+      if not entity:
+         continue
+      key = _time_key(entity)
+      changed = _backend.get(key)
+      if changed is None:
+         changed = time.time()
+         _backend.add(key, changed)
+      latest = max(latest, changed)
+   return latest
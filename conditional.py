@@ -0,0 +1,71 @@
+"""Conditional GET (ETag / Last-Modified / 304) for game and vote pages.
+
+A page's validators come from what it shows: the change versions and last
+change times of its game and vote (changes.py), the update timestamps of
+the entities it was fetched from, the viewing user (pages differ per
+user) and the deployed version of the app (templates differ per deploy).
+Handlers compute them after their keyed lookups and access checks and
+answer 304 before any query or rendering.
+
+Last-Modified has a resolution of one second, so it is left out while
+the last change is in the current second; a client could otherwise miss a
+second change within that second.
+"""
+
+import calendar
+import email.utils
+import hashlib
+import os
+import time
+
+import changes
+
+
+def validators(user, watched, timestamps=()):
+   """Returns (etag, last modified time in seconds or None)
+
+   watched: the games and votes (entities or keys) the page shows
+   timestamps: update times (datetimes) of the entities it renders
+   """
+   parts = [os.environ.get('CURRENT_VERSION_ID', ''), user.email(),
+            changes.token(*watched)]
+   parts.extend([t.isoformat() for t in timestamps if t])
+   etag = '"%s"' % hashlib.md5('|'.join(parts)).hexdigest()
+
+   last_modified = changes.last_changed(*watched)
+   for t in timestamps:
+      if t:
+         last_modified = max(last_modified, calendar.timegm(t.utctimetuple()))
+   if int(last_modified) >= int(time.time()):
+      last_modified = None
+   return etag, last_modified
+
+def not_modified(handler, etag, last_modified):
+   """Sets the validators on handler's response and checks the request's
+
+   Returns true, having set status 304, if the client's copy is current.
+   If-None-Match takes precedence over If-Modified-Since.
+   """
+   headers = handler.response.headers
+   headers['ETag'] = etag
+   # per user, and must be revalidated on every view
+   headers['Cache-Control'] = 'private, no-cache'
+   if last_modified:
+      headers['Last-Modified'] = email.utils.formatdate(last_modified,
+                                                        usegmt=True)
+
+   if_none_match = handler.request.headers.get('If-None-Match')
+   if_modified_since = handler.request.headers.get('If-Modified-Since')
+   if if_none_match:
+      tags = [tag.strip() for tag in if_none_match.split(',')]
+      current = etag in tags or '*' in tags
+   elif if_modified_since and last_modified:
+      since = email.utils.parsedate_tz(if_modified_since)
+      current = since is not None and \
+         email.utils.mktime_tz(since) >= int(last_modified)
+   else:
+      current = False
+
+   if current:
+      handler.response.set_status(304)
+   return current
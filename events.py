@@ -0,0 +1,193 @@
+"""Per-game activity feed (FeedPage, /feed).
+
+Handlers append a GameEvent (a child of the game) whenever a stage
+starts, a player dies or comes back, or a vote opens or closes with its
+result.  Events are never changed, so the feed is the newest FEED_SIZE
+events from one ancestor query.
+
+The rendered feed is cached in memcache together with its ETag and
+Last-Modified, keyed by the game's feed version, which record() bumps
+after storing events.  A render that read the events before a record()
+can only cache its body under the version it read, which readers have
+stopped asking for.  A feed reader polling an idle game costs two
+memcache gets and, with a conditional request, an empty 304.
+
+Feed readers cannot sign in, so a feed URL carries the game's feed
+secret (feed_token()), a random value stored on the Game, instead; players
+find the URL on the play page.  Polls check it against a copy in memcache
+(check_feed_token()).
+"""
+
+import calendar
+import hashlib
+import os
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import resolution
+import templatecache
+from models import Game, GameEvent
+from settings import DEBUG
+
+
+# Event kinds
+STAGE = 'stage'
+DEATH = 'death'
+REVIVAL = 'revival'
+VOTE_OPENED = 'voteopened'
+VOTE_CLOSED = 'voteclosed'
+
+# Entries in a feed
+FEED_SIZE = 50
+
+# How long a rendered feed stays cached (a new event replaces it sooner)
+FEED_CACHE_SECONDS = 60*60
+
+# Vote.outcome -> how a closed vote's result reads in the feed
+_RESULTS = {
+   resolution.TIE: 'tied, nobody was lynched',
+   resolution.NO_MAJORITY: 'no majority, nobody was lynched',
+   resolution.NO_VOTES: 'no votes were cast',
+   }
+
+
+def stage_name(stage):
+   if stage.isDay:
+      return 'Day %d' % stage.index
+   return 'Night %d' % stage.index
+
+def vote_name(vote):
+   return vote.name or 'Vote %d' % vote.index
+
+def player_name(player):
+   return player.alias or player.user.nickname()
+
+def result_text(vote):
+   """Describes the outcome recorded on a closed vote"""
+   if vote.outcome == resolution.LYNCH and vote.winner:
+      return '%s was lynched' % player_name(vote.winner)
+   return _RESULTS.get(vote.outcome, 'closed')
+
+
+def record(game_key, *events):
+   """Appends events, each a (kind, text) pair, to the game's feed"""
+   if not events:
+      return
+   db.put([GameEvent(parent = game_key, kind = kind, text = text)
+           for kind, text in events])
+   key = _version_key(game_key)
+   if memcache.incr(key) is None:
+      memcache.add(key, _seed())
+
+def stage_started(game_key, stage):
+   record(game_key, (STAGE, '%s began' % stage_name(stage)))
+
+def seats_changed(game_key, stage, players, dead=(), revived=()):
+   """Records deaths and revivals of seats in stage
+
+   players: the game's GamePlayers (or at least those seated in dead and
+   revived).
+   """
+   by_seat = dict([(p.index, p) for p in players])
+   events = []
+   for kind, seats, verb in ((DEATH, dead, 'died'),
+                             (REVIVAL, revived, 'is alive again')):
+      for seat in sorted(seats):
+         if seat in by_seat:
+            events.append((kind, '%s %s (%s)' % (
+               player_name(by_seat[seat]), verb, stage_name(stage))))
+   record(game_key, *events)
+
+def vote_opened(game_key, vote):
+   record(game_key, (VOTE_OPENED, '%s opened' % vote_name(vote)))
+
+def vote_closed(game_key, vote):
+   record(game_key, (VOTE_CLOSED, '%s closed: %s' % (vote_name(vote),
+                                                     result_text(vote))))
+
+
+def _secret_key(game_key):
+   return 'feedsecret:%s' % game_key
+
+def _create_feed_secret(game_key):
+   """Gives the game a random feed secret unless it has one (run in a
+   transaction)"""
+   game = db.get(game_key)
+   if not game.feedSecret:
+      game.feedSecret = os.urandom(16).encode('hex')
+      game.put()
+   return game.feedSecret
+
+def feed_token(game):
+   """Returns the secret that authorizes reading the game's feed
+
+   Created on first use for games that do not have one yet.
+   """
+   return game.feedSecret or db.run_in_transaction(_create_feed_secret,
+                                                   game.key())
+
+def check_feed_token(game_key, token):
+   """Returns whether token is the feed secret of the game (key)"""
+   key = _secret_key(game_key)
+   secret = memcache.get(key)
+   if secret is None:
+      game = db.get(game_key)
+      if not isinstance(game, Game) or not game.feedSecret:
+         return False
+      secret = game.feedSecret
+      memcache.set(key, secret)
+   return token == secret
+
+def _version_key(game_key):
+   return 'feedversion:%s' % game_key
+
+def _seed():
+   # from the clock, so a version memcache forgot comes back larger
+   return int(time.time() * 1000)
+
+def _feed_version(game_key):
+   key = _version_key(game_key)
+   version = memcache.get(key)
+   if version is None:
+      memcache.add(key, _seed())
+      version = memcache.get(key)
+   return version
+
+def _feed_cache_key(game_key, version):
+   return 'feed:%s:%s:%s' % (os.environ.get('CURRENT_VERSION_ID', ''),
+                             game_key, version)
+
+def render_feed(game_key, request):
+   """Returns (etag, last modified seconds, body) of the game's feed
+
+   Served from memcache while no event has been recorded since.  Returns
+   None if the game does not exist.
+   """
+   # read the version before the events: a render racing record() then
+   # caches under a version that is already out of date
+   key = _feed_cache_key(game_key, _feed_version(game_key))
+   cached = memcache.get(key)
+   if cached is not None:
+      return cached
+   game = db.get(game_key)
+   if not game:
+      return None
+
+   events = GameEvent.all().ancestor(game).order('-created').fetch(FEED_SIZE)
+   if events:
+      updated = events[0].created
+   else:
+      updated = game.created
+   body = templatecache.render('game_atom.xml', {
+      'game': game,
+      'events': events,
+      'updated': updated,
+      'request': request,
+      'application_name': 'VoteLynch',
+      }, debug=DEBUG).encode('utf-8')
+   cached = ('"%s"' % hashlib.md5(body).hexdigest(),
+             calendar.timegm(updated.utctimetuple()), body)
+   memcache.set(key, cached, FEED_CACHE_SECONDS)
+   return cached
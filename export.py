@@ -0,0 +1,145 @@
+"""Export of a game's full history as NDJSON or CSV (see ExportPage).
+
+records() is a generator pipeline: it walks the game's stages, each
+stage's votes and each vote's choices with cursor-paged queries, so only
+one page of rows is held at a time.  Players and choices refer to seats;
+the seat of every GamePlayer key comes from one query for the game's
+players up front, so no row costs a reference fetch.
+
+A response covers whole stages until it has produced at least max_rows
+records and then ends with a 'next' record naming the stage to continue
+from (the start parameter of ExportPage).  Compacted games are exported in
+one go from their GameArchive.
+"""
+
+import csv
+
+from django.utils import simplejson
+
+from google.appengine.ext import db
+
+import alivestate
+from models import GameArchive, Stage, Vote, VoteGamePlayer, VoteResult
+
+
+# Entities fetched per datastore round trip
+EXPORT_PAGE_SIZE = 200
+
+# Records after which a response stops at the next stage boundary
+EXPORT_MAX_ROWS = 5000
+
+# Column order of the CSV format; each record sets the columns it needs
+# (in choice records 'seat' is the voter; counts are 'seat:votes' pairs)
+CSV_COLUMNS = ('type', 'stage', 'vote', 'seat', 'choice', 'name', 'isDay',
+               'seats', 'alive', 'isOpen', 'outcome', 'winner', 'counts',
+               'created')
+
+
+def _paged(query, page_size=EXPORT_PAGE_SIZE):
+   """Yields every entity of query, fetching page_size at a time"""
+   while True:
+      page = query.fetch(page_size)
+      for entity in page:
+         yield entity
+      if len(page) < page_size:
+         return
+      query.with_cursor(query.cursor())
+
+def _stage_record(index, is_day, seats, alive):
+   return {'type': 'stage', 'stage': index, 'isDay': is_day,
+           'seats': seats, 'alive': sorted(alive)}
+
+def _live_records(game, start, max_rows):
+   players = alivestate.game_players(game)
+   seat_of = dict([(p.key(), p.index) for p in players])
+   if not start:
+      yield {'type': 'game', 'name': game.name,
+             'created': game.created.isoformat()}
+      for player in players:
+         yield {'type': 'player', 'seat': player.index,
+                'name': player.alias or player.user.nickname()}
+
+   rows = 0
+   stages = Stage.all().filter('game =', game).filter('index >=', start) \
+                 .order('index')
+   for stage in _paged(stages):
+      if max_rows and rows >= max_rows:
+         yield {'type': 'next', 'stage': stage.index}
+         return
+      yield _stage_record(stage.index, stage.isDay, stage.seats,
+                          alivestate.alive_seats(stage))
+      rows += 1
+      votes = Vote.all().filter('stage =', stage).order('index')
+      for vote in _paged(votes):
+         counts = None
+         if not vote.isOpen:
+            result = db.get(VoteResult.key_for(vote))
+            if result:
+               counts = sorted([[seat_of.get(db.Key(k)), n] for k, n in
+                                result.result()['counts'].items()])
+         yield {'type': 'vote', 'stage': stage.index, 'vote': vote.index,
+                'name': vote.name, 'isOpen': vote.isOpen,
+                'outcome': vote.outcome,
+                'winner': seat_of.get(
+                   Vote.winner.get_value_for_datastore(vote)),
+                'counts': counts,
+                'created': vote.created.isoformat()}
+         rows += 1
+         for choice in _paged(VoteGamePlayer.all().filter('vote =', vote)):
+            yield {'type': 'choice', 'stage': stage.index,
+                   'vote': vote.index,
+                   'seat': seat_of.get(
+                      VoteGamePlayer.player.get_value_for_datastore(choice)),
+                   'choice': seat_of.get(
+                      VoteGamePlayer.choice.get_value_for_datastore(choice))}
+            rows += 1
+
+def _archived_records(history):
+   yield {'type': 'game', 'name': history['name'],
+          'created': history['created']}
+   for player in history['players']:
+      yield {'type': 'player', 'seat': player['seat'],
+             'name': player['alias']}
+   for stage in history['stages']:
+      yield _stage_record(stage['index'], stage['isDay'], stage['seats'],
+                          stage['alive'])
+      for vote in stage['votes']:
+         yield {'type': 'vote', 'stage': stage['index'],
+                'vote': vote['index'], 'name': vote['name'],
+                'isOpen': False, 'outcome': vote.get('outcome'),
+                'winner': vote.get('winner'), 'counts': vote.get('counts'),
+                'created': vote['created']}
+         for voter, choice in vote['choices']:
+            yield {'type': 'choice', 'stage': stage['index'],
+                   'vote': vote['index'], 'seat': voter, 'choice': choice}
+
+def records(game, start=0, max_rows=EXPORT_MAX_ROWS):
+   """Yields the export records of game, from stage index start on"""
+   archive = GameArchive.get_by_key_name(str(game.key()))
+   if archive:
+      return _archived_records(archive.history())
+   return _live_records(game, start, max_rows)
+
+
+def ndjson_lines(records):
+   """Yields each record as a line of JSON"""
+   for record in records:
+      yield simplejson.dumps(record) + '\n'
+
+def _csv_value(value):
+   if value is None:
+      return ''
+   if isinstance(value, list):
+      return ' '.join([isinstance(v, list) and ':'.join(map(str, v))
+                       or str(v) for v in value])
+   if isinstance(value, unicode):
+      return value.encode('utf-8')
+   return value
+
+def write_csv(records, out):
+   """Writes a header row and one row per record to the file-like out"""
+   writer = csv.writer(out)
+   writer.writerow(CSV_COLUMNS)
+   for record in records:
+      writer.writerow([_csv_value(record.get(column))
+                       for column in CSV_COLUMNS])
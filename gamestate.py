@@ -0,0 +1,106 @@
+"""Game state for JSON clients (GameStateApi, /api/game).
+
+state() puts together everything a client shows for a game: the current
+stage, the roster with alive flags, the stage's votes with their tallies
+and the caller's own cast in each open vote.  It reads the stage snapshot
+(snapshots.py, with the open votes' live tallies) plus one batch get for
+the caller's casts.
+
+Responses carry a version made of the game's change version and a digest
+of each section ('roster' and 'votes').  A client that sends its last
+version back as since gets:
+  - {"changed": false} at the cost of a memcache read, if the game's
+    change version has not moved
+  - otherwise only the sections whose digest differs from its own
+"""
+
+import hashlib
+
+from google.appengine.ext import db
+from django.utils import simplejson
+
+import castqueue
+import changes
+import snapshots
+from models import Game, VoteGamePlayer
+
+
+def _digest(section):
+   return hashlib.md5(simplejson.dumps(section, sort_keys=True)) \
+                 .hexdigest()[:8]
+
+def _parse_version(version):
+   """Returns (change version, {section: digest}) of a client's version"""
+   parts = (version or '').split('.')
+   if len(parts) != 3:
+      return None, {}
+   return parts[0], {'roster': parts[1], 'votes': parts[2]}
+
+def unchanged(game_key, since):
+   """Returns true if nothing changed in the game since version since"""
+   return _parse_version(since)[0] == changes.token(game_key)
+
+def _own_casts(votes, user):
+   """Returns {vote key: key string of user's choice} for open votes"""
+   open_keys = [db.Key(vote['key']) for vote in votes if vote['isOpen']]
+   casts = {}
+   missing = []
+   for vote_key in open_keys:
+      # a queued cast is newer than the stored one
+      choice = castqueue.pending_choice(vote_key, user)
+      if choice:
+         casts[str(vote_key)] = str(choice)
+      else:
+         missing.append(vote_key)
+   rows = db.get([VoteGamePlayer.key_for(vote_key, user)
+                  for vote_key in missing])
+   for vote_key, row in zip(missing, rows):
+      if row:
+         casts[str(vote_key)] = str(
+            VoteGamePlayer.choice.get_value_for_datastore(row))
+   return casts
+
+def state(game, user, since=None):
+   """Returns the JSON-able state of game for user
+
+   Sections unchanged since the client's version since are left out.
+   """
+   version = changes.token(game)
+   stage_key = Game.currentStage.get_value_for_datastore(game)
+   if stage_key:
+      snapshot, data = snapshots.get(game.key(), stage_key)
+      roster = {
+         'stage': data['stage'],
+         'players': [dict(player, alive=True) for player in data['alive']] +
+                    [dict(player, alive=False) for player in data['dead']],
+         }
+      casts = _own_casts(data['votes'], user)
+      votes = [{
+         'key': vote['key'],
+         'name': vote['name'],
+         'index': vote['index'],
+         'isOpen': vote['isOpen'],
+         'counts': vote['counts'],
+         'leaders': [leader['key'] for leader in vote['leaders']],
+         'cast': casts.get(vote['key']),
+         } for vote in data['votes']]
+   else:
+      roster = {'stage': None, 'players': []}
+      votes = []
+
+   digests = {'roster': _digest(roster), 'votes': _digest(votes)}
+   response = {
+      'version': '%s.%s.%s' % (version, digests['roster'], digests['votes']),
+      'changed': True,
+      'game': {
+         'key': str(game.key()),
+         'name': game.name,
+         'archived': game.archived,
+         },
+      }
+   known = _parse_version(since)[1]
+   if known.get('roster') != digests['roster']:
+      response['roster'] = roster
+   if known.get('votes') != digests['votes']:
+      response['votes'] = votes
+   return response
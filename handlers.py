@@ -3,10 +3,62 @@ from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
-import os
+from django.utils import simplejson
+import hashlib
+import time
+
+from models import Game, GameModerator, GamePlayer, Stage
+from models import Vote, VoteGamePlayer, VoteResult
+
+import aclcache
+import alivestate
+import castqueue
+import changes
+import conditional
+import events
+import gamestate
+import instrument
+import ratelimit
+import resolution
+import snapshots
+import stages
+import tally
+import templatecache
+from settings import DEBUG, MMSALT, QUEUE_CASTS
+
+
+def action_login_required(handler_method):
+   """Decorator for POST actions: answers 403 unless a user is signed in
+
+   webapp's login_required only supports GET (it redirects to the login
+   page, and raises for any other method).
+   """
+   def check_login(self, *args):
+      if not users.GetCurrentUser():
+         self.error(403)
+         return
+      handler_method(self, *args)
+   return check_login
+
+def rate_limited(handler_method):
+   """Decorator for POST actions: answers 429 when ratelimit refuses them
+
+   Goes under action_login_required, as the buckets are per user.  The
+   user's bucket is checked before the action touches the datastore; the
+   action checks the game's itself once it knows the game (admit_game).
+   """
+   def check_rate(self, *args):
+      wait = ratelimit.check_user(self.request.path, users.GetCurrentUser())
+      if wait:
+         self.too_many_requests(wait)
+         return
+      handler_method(self, *args)
+   return check_rate
+
+def _password_hash(password):
+   """Returns the salted hash stored in Game.password_hash"""
+   return hashlib.md5(MMSALT + password.encode('utf-8')).hexdigest()
 
-from models import Game
-from votelynch import _DEBUG
 
 
 class BaseRequestHandler(webapp.RequestHandler):
@@ -16,19 +68,43 @@ class BaseRequestHandler(webapp.RequestHandler):
    the current user in the 'user' variable and the current webapp request
    in the 'request' variable.
    """
+   def initialize(self, request, response):
+      webapp.RequestHandler.initialize(self, request, response)
+      aclcache.reset_request()
+      instrument.set_handler(self.__class__.__name__)
+   
    def generate(self, template_name, template_values={}):
       values = {
             'request': self.request,
             'user': users.GetCurrentUser(),
-            'login_url': users.CreateLoginURL(self.request.uri),
-            'logout_url': users.CreateLogoutURL('http://' + self.request.host + '/'),
+            'login_url': templatecache.Lazy(users.CreateLoginURL,
+                                            self.request.uri),
+            'logout_url': templatecache.Lazy(users.CreateLogoutURL,
+                                    'http://' + self.request.host + '/'),
             'debug': self.request.get('deb'),
             'application_name': 'VoteLynch',
          }
       values.update(template_values)
-      directory = os.path.dirname(__file__)
-      path = os.path.join(directory, os.path.join('templates', template_name))
-      self.response.out.write(template.render(path, values, debug=_DEBUG))
+      start = time.time()
+      self.response.out.write(
+         templatecache.render(template_name, values, debug=DEBUG))
+      instrument.record_render(time.time() - start)
+   
+   def too_many_requests(self, wait):
+      self.response.set_status(429, 'Too Many Requests')
+      self.response.headers['Retry-After'] = str(wait)
+   
+   def admit_game(self, game_key):
+      """Takes a token from the game's bucket for this action
+
+      game_key must come from the loaded entities, never from the request.
+      Answers 429 and returns false if the bucket is empty.
+      """
+      wait = ratelimit.check_game(self.request.path, game_key)
+      if wait:
+         self.too_many_requests(wait)
+         return False
+      return True
 
 class MainPage(BaseRequestHandler):
    """Display games moderating and participaing.
@@ -36,22 +112,38 @@ class MainPage(BaseRequestHandler):
          Links:
             create game (/creategame)
 
+         Query parameters:
+            archive (include archived games)
+            list, page (show the page of the 'playing' or 'moderating'
+                        list starting at cursor 'page', that list only)
+
          Template variables:
             list_of_games_playing
             list_of_games_moderating
+            next_page_playing (cursor of the next page, if any)
+            next_page_moderating
             archive (flag if archives are being displayed)
    """
    @login_required
    def get(self):
-      games_playing = Game.get_current_user_games_playing()
-      games_moderating = Game.get_current_user_games_moderating()
-      show_archive = self.request.get('archive')
-      if not show_archive:    # get only non archived games
-         games_playing = [game for game in games_playing if not game.archived]
-         games_moderating = [game for game in games_moderating if not game.archived]
+      show_archive = bool(self.request.get('archive'))
+      paged_list = self.request.get('list')
+      page = paged_list and self.request.get('page') or None
+      
+      games_playing, next_page_playing = [], None
+      games_moderating, next_page_moderating = [], None
+      if paged_list != 'moderating':
+         games_playing, next_page_playing = \
+            Game.get_current_user_games_playing(show_archive, page)
+      if paged_list != 'playing':
+         games_moderating, next_page_moderating = \
+            Game.get_current_user_games_moderating(show_archive, page)
+      
       self.generate('index.html', {
          'list_of_games_playing': games_playing,
          'list_of_games_moderating': games_moderating,
+         'next_page_playing': next_page_playing,
+         'next_page_moderating': next_page_moderating,
          'archive': show_archive,
          })
 
@@ -77,9 +169,10 @@ class CreateGameAction(BaseRequestHandler):
             Creates new game
             Redirects to /managegame?game=<newgameid>
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
-      user = users.GetCurrentuser()
+      user = users.GetCurrentUser()
       
       # Name and password for game
       name = self.request.get('name')
@@ -89,12 +182,14 @@ class CreateGameAction(BaseRequestHandler):
          self.error(403)
          return
       
-      password_hash = md5(MMSALT+password)
+      password_hash = _password_hash(password)
       
-      game = Game(name=name, password_hash = password_hash)
+      game = Game(name=name, password_hash = password_hash,
+                  moderatorUsers = [user])
       game.put()
       
-      game_moderator = GameModerator(game=game, user=user)
+      game_moderator = GameModerator(parent=game, key_name=user.email(),
+                                     game=game, user=user)
       game_moderator.put()
       
       if self.request.get('next'):
@@ -129,10 +224,15 @@ class ManageGamePage(BaseRequestHandler):
          self.error(403)
          return
       
+      etag, last_modified = conditional.validators(
+         users.GetCurrentUser(), [game], [game.updated])
+      if conditional.not_modified(self, etag, last_modified):
+         return
+      
       list_of_stages = game.stages
       if game.currentStage:
-         current_stage = Stage.get(game.currentStage)
-         list_of_votes = currentstage.votes
+         current_stage = game.currentStage
+         list_of_votes = current_stage.votes
       else:
          current_stage = None
          list_of_votes = []
@@ -151,10 +251,11 @@ class CreateStageAction(BaseRequestHandler):
             game
 
          Handler:
-            Creates new stage and new StageGamePlayer relationships for each player
+            Creates new stage, carrying over the previous stage's alive players
             redirects to /managestage?stage=<stageid>
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
       game = Game.get(self.request.get('game'))
       
@@ -166,28 +267,10 @@ class CreateStageAction(BaseRequestHandler):
          self.error(403)
          return
       
-      #need the currentStage for index and day/night swap
-      if game.currentStage:
-         current_stage = game.currentStage
-         new_stage = Stage(index = current_stage.index + 1, game = game)
-         new_stage.isDay = not current_stage.isDay
-         for player in current_stage.StageGamePlayer_set:
-            #copy values from previous StageGamePlayer relationships
-            new_player = StageGamePlayer(stage = new_stage,
-                                         player = player.player,
-                                         isAlive = player.isAlive)
-            new_player.put()
-            
-      else:
-         new_stage = Stage(index = 0, game = game, isDay = True)
-         for player in game.GamePlayer_set:
-            #create values from players in game
-            new_player = StageGamePlayer(stage = new_stage,
-                                         player = player,
-                                         isALive = True)
-            new_player.put()
+      if not self.admit_game(game.key()):
+         return
       
-      new_stage.put()
+      new_stage = stages.create_next_stage(game)
       
       self.redirect('/managestage?stage=' + str(new_stage.key()))
       
@@ -205,10 +288,11 @@ class ManageStagePage(BaseRequestHandler):
          A list of players from the stage should be on the page
           with a tick box next to their name. This is for the moderator
           to select the players who died in the previous stage
-           (list of StageGamePlayers - tick boxes)
+           (lists of GamePlayers - tick boxes)
 
          Template Variables:
-            list_of_stagegameplayers
+            list_of_live_players
+            list_of_dead_players
             stage
 
          NOTE: This page may be deemed redundant. This information can all be on the
@@ -231,10 +315,11 @@ class ManageStagePage(BaseRequestHandler):
          self.error(403)
          return
       
-      list_of_stagegameplayers = [p for p in stage.StageGamePlayers_set]
+      list_of_live_players, list_of_dead_players = alivestate.roster(stage)
                   
       self.generate('managestage.html', {
-         'list_of_stagegameplayers': list_of_stagegameplayers,
+         'list_of_live_players': list_of_live_players,
+         'list_of_dead_players': list_of_dead_players,
          'stage': stage
          })
 
@@ -242,50 +327,146 @@ class ManageStageAction(BaseRequestHandler):
    """ url: /managestage.do
    
          POST action to update stage (selecting alive players)
+         Applies the whole alive set in one write, so resolving a night
+         with several deaths is a single request.
+
+         Post fields:
+            stage
+            alive (repeated - GamePlayer ids of every player alive in the
+                   stage; everyone else in the stage is dead)
+
+         redirects to /managestage?stage=<stageid>
    """
-   pass
+   @action_login_required
+   @rate_limited
+   def post(self):
+      stage = Stage.get(self.request.get('stage'))
+      
+      if not stage:
+         self.error(403)         # stage does not exist
+         return
+      
+      if not stage.game.current_user_moderating():
+         self.error(403)
+         return
+      
+      try:
+         keys = [db.Key(k) for k in self.request.get_all('alive')]
+      except (db.BadKeyError, db.BadArgumentError):
+         self.error(403)
+         return
+      
+      game_key = Stage.game.get_value_for_datastore(stage)
+      if not self.admit_game(game_key):
+         return
+      
+      players = db.get(keys)
+      for player in players:
+         if not isinstance(player, GamePlayer) or \
+               GamePlayer.game.get_value_for_datastore(player) != game_key:
+            self.error(403)
+            return
+         if player.index is None:
+            # not seated yet (see alivestate.migrate_stage)
+            self.error(403)
+            return
+      
+      before = alivestate.alive_seats(stage)
+      after = set([p.index for p in players])
+      alivestate.replace_seats(stage.key(), after)
+      # derived state is refreshed once for the whole batch
+      changes.bump(game_key)
+      snapshots.rebuild(stage.key())
+      if before != after:
+         events.seats_changed(game_key, stage,
+                              alivestate.game_players(game_key),
+                              dead = before - after, revived = after - before)
+      
+      if self.request.get('next'):
+         self.redirect(self.request.get('next'))
+      else:
+         self.redirect('/managestage?stage=' + str(stage.key()))
 
 class KillPlayerAction(BaseRequestHandler):
    """
-      url: /killplayer.do?player=<StageGamePlayer_id>
+      url: /killplayer.do?stage=<stageid>&player=<GamePlayer_id>
       
-         sets a players isAlive to False
+         sets a players seat dead in the stage
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
-      player = StageGamePlayer.get(self.request.get('player'))
+      stage = Stage.get(self.request.get('stage'))
+      player = GamePlayer.get(self.request.get('player'))
+      
+      if not stage or not player:
+         self.error(403)
+         return
+      
+      game_key = Stage.game.get_value_for_datastore(stage)
+      if GamePlayer.game.get_value_for_datastore(player) != game_key:
+         self.error(403)
+         return
       
-      if not player:
+      if player.index is None:
+         # not seated yet (see alivestate.migrate_stage)
          self.error(403)
          return
       
-      if not player.stage.game.current_user_moderating():
+      if not stage.game.current_user_moderating():
          self.error(403)
          return
       
-      player.isAlive = False
-      player.put()
+      if not self.admit_game(game_key):
+         return
+      
+      was_alive = alivestate.is_alive(stage, player.index)
+      alivestate.update_seats(stage.key(), dead=[player.index])
+      changes.bump(game_key)
+      snapshots.rebuild(stage.key())
+      if was_alive:
+         events.seats_changed(game_key, stage, [player], dead=[player.index])
 
 class RevivePlayerAction(BaseRequestHandler):
    """
-      url: /reviveplayer.do?player=<StageGamePlayer_id>
+      url: /reviveplayer.do?stage=<stageid>&player=<GamePlayer_id>
       
-         sets a players isAlive to True
+         sets a players seat alive in the stage
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
-      player = StageGamePlayer.get(self.request.get('player'))
+      stage = Stage.get(self.request.get('stage'))
+      player = GamePlayer.get(self.request.get('player'))
+      
+      if not stage or not player:
+         self.error(403)
+         return
       
-      if not player:
+      game_key = Stage.game.get_value_for_datastore(stage)
+      if GamePlayer.game.get_value_for_datastore(player) != game_key:
          self.error(403)
          return
       
-      if not player.stage.game.current_user_moderating():
+      if player.index is None:
+         # not seated yet (see alivestate.migrate_stage)
          self.error(403)
          return
       
-      player.isAlive = True
-      player.put()
+      if not stage.game.current_user_moderating():
+         self.error(403)
+         return
+      
+      if not self.admit_game(game_key):
+         return
+      
+      was_alive = alivestate.is_alive(stage, player.index)
+      alivestate.update_seats(stage.key(), alive=[player.index])
+      changes.bump(game_key)
+      snapshots.rebuild(stage.key())
+      if not was_alive:
+         events.seats_changed(game_key, stage, [player],
+                              revived=[player.index])
 
 class CreateVoteAction(BaseRequestHandler):
    """POST action to create a vote
@@ -294,8 +475,13 @@ class CreateVoteAction(BaseRequestHandler):
          Creates a new vote in the current stage of the game
          by default adds all alive players, moderators can remove from the manage page
          redirects to /managevote?vote=<voteid>
+
+         Optional parameters:
+            method (plurality, majority)
+            tiebreak (nolynch, random)
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
       game = Game.get(self.request.get('game'))
       
@@ -312,6 +498,9 @@ class CreateVoteAction(BaseRequestHandler):
          self.error(403)
          return
       
+      if not self.admit_game(game.key()):
+         return
+      
       
       current_stage = game.currentStage
       
@@ -320,9 +509,20 @@ class CreateVoteAction(BaseRequestHandler):
       else:
          index = 0
          
-      new_vote = Vote(stage = current_stage, index = index)
+      method = self.request.get('method', resolution.PLURALITY)
+      tie_break = self.request.get('tiebreak', resolution.TIE_NO_LYNCH)
+      if method not in (resolution.PLURALITY, resolution.MAJORITY) or \
+            tie_break not in (resolution.TIE_NO_LYNCH, resolution.TIE_RANDOM):
+         self.error(400)
+         return
+      
+      new_vote = Vote(stage = current_stage, index = index, method = method,
+                      tieBreak = tie_break)
       
       new_vote.put()
+      changes.bump(game)
+      snapshots.rebuild(current_stage, [new_vote])
+      events.vote_opened(game.key(), new_vote)
       self.redirect('/managevote?vote=' + str(new_vote.key()))
 
 class ManageVotePage(BaseRequestHandler):
@@ -337,7 +537,12 @@ class ManageVotePage(BaseRequestHandler):
             End - /endvote.do?vote=<voteid>
 
          Template variables:
-            list_of_stagegameplayers - should show who they voted for
+            list_of_live_players - should show who they voted for
+            list_of_dead_players
+            vote
+            stage (None once the vote is closed)
+            game_key
+            result (the frozen VoteResult data of a closed vote)
 
             created
             updated
@@ -349,23 +554,52 @@ class ManageVotePage(BaseRequestHandler):
    """
    @login_required
    def get(self):
-      vote = Vote.get(self.request.get('vote'))
+      try:
+         vote_key = db.Key(self.request.get('vote'))
+      except (db.BadKeyError, db.BadArgumentError):
+         self.error(403)
+         return
       
-      if not vote:
+      # a closed vote is shown from its result alone
+      vote, result = db.get([vote_key, VoteResult.key_for(vote_key)])
+      
+      if not isinstance(vote, Vote):
          self.error(403)
          return
-         
-      if not vote.stage.game.current_user_moderating():
+      
+      if vote.isOpen or not result:
+         result = None
+         stage = vote.stage
+         game_key = Stage.game.get_value_for_datastore(stage)
+      else:
+         stage = None
+         game_key = VoteResult.game.get_value_for_datastore(result)
+      
+      user = users.GetCurrentUser()
+      if not Game.get_moderator_key(game_key, user):
          self.error(403)
          return
       
-      list_of_stagegameplayers = vote.stage.players
+      etag, last_modified = conditional.validators(
+         user, [game_key, vote], [vote.updated, stage and stage.updated])
+      if conditional.not_modified(self, etag, last_modified):
+         return
+      
+      if result:
+         result = result.result()
+         list_of_live_players = result['alive']
+         list_of_dead_players = result['dead']
+      else:
+         list_of_live_players, list_of_dead_players = \
+            alivestate.roster(stage)
       
       self.generate('managevote.html', {
-         'list_of_stagegameplayers': list_of_stages,
+         'list_of_live_players': list_of_live_players,
+         'list_of_dead_players': list_of_dead_players,
          'vote': vote,
-         'stage': vote.stage,
-         'game': vote.stage.game,
+         'stage': stage,
+         'game_key': game_key,
+         'result': result,
          })
 
 class OpenVoteAction(BaseRequestHandler):
@@ -373,7 +607,8 @@ class OpenVoteAction(BaseRequestHandler):
 
          Opens vote for players to cast their choice
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
       vote = Vote.get(self.request.get('vote'))
       
@@ -385,8 +620,22 @@ class OpenVoteAction(BaseRequestHandler):
          self.error(403)
          return
       
+      game_key = Stage.game.get_value_for_datastore(vote.stage)
+      if not self.admit_game(game_key):
+         return
+      
+      was_open = vote.isOpen
       vote.isOpen = True
+      # a reopened vote is decided again when it next closes
+      vote.outcome = None
+      vote.winner = None
+      vote.resolved = None
       vote.put()
+      db.delete(VoteResult.key_for(vote))
+      changes.bump(vote, game_key)
+      snapshots.rebuild(vote.stage, [vote])
+      if not was_open:
+         events.vote_opened(game_key, vote)
       
       if self.request.get('next'):
          self.redirect(self.request.get('next'))
@@ -394,9 +643,12 @@ class OpenVoteAction(BaseRequestHandler):
 class CloseVoteAction(BaseRequestHandler):
    """ url: /closevote.do?vote=<voteid>
 
-         Closes vote so players cannot vote
+         Closes vote so players cannot vote, folds in any queued casts
+         (castqueue.drain) and records its outcome and frozen VoteResult
+         (resolution.resolve)
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
       vote = Vote.get(self.request.get('vote'))
       
@@ -408,8 +660,22 @@ class CloseVoteAction(BaseRequestHandler):
          self.error(403)
          return
       
-      vote.isOpen = False
-      vote.put()
+      game_key = Stage.game.get_value_for_datastore(vote.stage)
+      if not self.admit_game(game_key):
+         return
+      
+      # closing a closed, resolved vote again leaves its result alone
+      if vote.isOpen or not db.get(VoteResult.key_for(vote)):
+         was_open = vote.isOpen
+         vote.isOpen = False
+         vote.put()
+         # no cast is accepted from here on; fold in the ones already queued
+         castqueue.drain(vote.key())
+         db.put([vote, resolution.resolve(vote)])
+         changes.bump(vote, game_key)
+         snapshots.rebuild(vote.stage, [vote])
+         if was_open:
+            events.vote_closed(game_key, vote)
       
       if self.request.get('next'):
          self.redirect(self.request.get('next'))
@@ -442,8 +708,9 @@ class JoinGamePage(BaseRequestHandler):
       
       #Check if user is already in the game
       user = users.GetCurrentUser()
-      if user in game.players:
+      if game.user_playing(user):
          self.redirect('/play?game=' + str(game.key()))
+         return
       
       self.generate('joingame.html', {
          'game_name': game.name,
@@ -459,7 +726,8 @@ class JoinGameAction(BaseRequestHandler):
 
          redirects to /play?game=<gameid>
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
       game = Game.get(self.request.get('game'))
       
@@ -469,8 +737,9 @@ class JoinGameAction(BaseRequestHandler):
       
       #Check if user is already in the game
       user = users.GetCurrentUser()
-      if user in game.players:
+      if game.user_playing(user):
          self.redirect('/play?game=' + str(game.key()))
+         return
       
       alias = self.request.get('alias')
       # Need to introduce some alias input checks here
@@ -478,13 +747,16 @@ class JoinGameAction(BaseRequestHandler):
          self.error(403)
          return
       
+      if not self.admit_game(game.key()):
+         return
+      
       password = self.request.get('password')
-      if (md5(MMSALT+password) != game.password_hash):
+      if _password_hash(password) != game.password_hash:
          self.error(403)
          return
       
-      new_gameplayer = GamePlayer(user = user, game = game)
-      new_gameplayer.put()
+      alivestate.join(game.key(), user, alias)
+      aclcache.invalidate(aclcache.PLAYER, game, user)
       
       self.redirect('/play?game=' + str(game.key()))
 
@@ -497,10 +769,11 @@ class PlayGamePage(BaseRequestHandler):
          Just a live list and links to active votes
 
          Template variables:
-            current_stage
-            list_of_live_stagegameplayers
-            list_of_dead_stagegameplayers
-            list_of_votes
+            game
+            snapshot (StageSnapshot of the current stage, if any)
+            state (its data: stage, alive, dead, votes with leaders)
+            version (for /changes)
+            feed_url (the game's Atom feed)
    """
    @login_required
    def get(self):
@@ -513,23 +786,33 @@ class PlayGamePage(BaseRequestHandler):
       user = users.GetCurrentUser()
       
       # User needs to join game
-      if user not in game.players:
-         self.redirect('/joingame?game=' + str(game.key()))
+      if not game.user_playing(user):
+         self.redirect('/join?game=' + str(game.key()))
+         return
       
-      list_of_live_stagegameplayers = []
-      list_of_dead_stagegameplayers = []
+      # Finished games are shown from their archive
+      if game.archived:
+         self.redirect('/history?game=' + str(game.key()))
+         return
       
-      for player in game.players:
-         if player.isAlive:
-            list_of_live_stagegameplayers.append(player)
-         else:
-            list_of_dead_stagegameplayers.append(player)
+      etag, last_modified = conditional.validators(user, [game],
+                                                   [game.updated])
+      if conditional.not_modified(self, etag, last_modified):
+         return
+      
+      stage_key = Game.currentStage.get_value_for_datastore(game)
+      if stage_key:
+         snapshot, state = snapshots.get(game.key(), stage_key)
+      else:
+         snapshot, state = None, None
       
       self.generate('play.html', {
-         'current_stage': game.currentStage,
-         'list_of_live_stagegameplayers': list_of_live_stagegameplayers,
-         'list_of_dead_stagegameplayers': list_of_dead_stagegameplayers,
-         'list_of_votes': game.currentStage.votes,
+         'game': game,
+         'snapshot': snapshot,
+         'state': state,
+         'version': changes.token(game),
+         'feed_url': '/feed?game=%s&token=%s' % (
+            game.key(), events.feed_token(game)),
          })
 
 class VotePage(BaseRequestHandler):
@@ -538,35 +821,77 @@ class VotePage(BaseRequestHandler):
          Players view vote options to vote, or voting results
 
          Template variables:
-            list_of_live_stagegameplayers
+            vote
+            game_key
+            list_of_live_players
             vote_cast (set if player has already voted, should be selected on the page)
+            result (the frozen VoteResult data of a closed vote)
+            version (for /changes)
    """
    @login_required
    def get(self):
-      vote = Vote.get(self.request.get('vote'))
-      
-      if not vote:
+      try:
+         vote_key = db.Key(self.request.get('vote'))
+      except (db.BadKeyError, db.BadArgumentError):
          self.error(403)
          return
       
-      user = users.GetCurrentUser()
+      # a closed vote is shown from its result alone
+      vote, result = db.get([vote_key, VoteResult.key_for(vote_key)])
       
-      list_of_live_stagegameplayers = vote.stage.players.filter('isAlive =', True)
+      if not isinstance(vote, Vote):
+         self.error(403)
+         return
       
-      stagegameplayer = \
-         next((p for p in list_of_live_stagegameplayers if p.player.user == user),
-               None)
+      user = users.GetCurrentUser()
+      if vote.isOpen or not result:
+         result = None
+         stage = vote.stage
+         game_key = Stage.game.get_value_for_datastore(stage)
+      else:
+         stage = None
+         game_key = VoteResult.game.get_value_for_datastore(result)
+      player_key = Game.get_player_key(game_key, user)
       
-      # User is not in game and alive
-      if not stagegameplayer:
+      # User is not in game
+      if not player_key:
          self.error(403)
          return
       
-      choice = vote.choices.filter('player =', stagegameplayer.player).choice
+      etag, last_modified = conditional.validators(
+         user, [game_key, vote], [vote.updated, stage and stage.updated])
+      if conditional.not_modified(self, etag, last_modified):
+         return
+      
+      if result:
+         result = result.result()
+         list_of_live_players = result['alive']
+         choice = result['choices'].get(str(player_key))
+      else:
+         list_of_live_players, list_of_dead_players = \
+            alivestate.roster(stage)
+         
+         # User is not in game and alive
+         if player_key not in [p.key() for p in list_of_live_players]:
+            self.error(403)
+            return
+         
+         # a queued cast is newer than the stored one
+         choice = castqueue.pending_choice(vote_key, user)
+         if not choice:
+            vote_game_player = VoteGamePlayer.get_by_key_name(
+               VoteGamePlayer.key_name_for(vote, user))
+            if vote_game_player:
+               choice = VoteGamePlayer.choice.get_value_for_datastore(
+                  vote_game_player)
       
       self.generate('vote.html', {
-         'list_of_live_stagegameplayers': list_of_live_stagegameplayers,
+         'vote': vote,
+         'game_key': game_key,
+         'list_of_live_players': list_of_live_players,
          'vote_cast': choice,
+         'result': result,
+         'version': changes.token(game_key, vote),
       })
 
 class CastVoteAction(BaseRequestHandler):
@@ -574,49 +899,102 @@ class CastVoteAction(BaseRequestHandler):
 
          Post fields:
             vote (id of the vote)
-            choice (players choice - choice is an id from list_of_stagegameplayers)
+            choice (players choice - choice is an id from list_of_live_players)
 
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
-      vote = Vote.get(self.request.get('vote'))
+      user = users.GetCurrentUser()
       
-      if not vote:
+      try:
+         vote_key = db.Key(self.request.get('vote'))
+         choice_key = db.Key(self.request.get('choice'))
+      except (db.BadKeyError, db.BadArgumentError):
          self.error(403)
          return
       
-      stage = vote.stage
-      game = stage.game
+      # the vote and the chosen player: both by key
+      vote, choice = db.get([vote_key, choice_key])
       
-      user = users.GetCurrentUser()
+      if not isinstance(vote, Vote) or not vote.isOpen:
+         self.error(403)
+         return
       
-      stage_game_player = next(p for p in stage.players if p.player.user == user), None
+      if not isinstance(choice, GamePlayer):
+         self.error(403)
+         return
       
-      if not stage_game_player or not stage_game_player.isAlive:
-         # player is not in stage or not alive
+      game_key = GamePlayer.game.get_value_for_datastore(choice)
+      player_key = Game.get_player_key(game_key, user)
+      if not player_key:
+         # player is not in the game
          self.error(403)
          return
       
-      choice = StageGamePlayer(self.request.get('choice'))
+      stage, player = db.get([Vote.stage.get_value_for_datastore(vote),
+                              player_key])
       
-      if not choice or not choice.isAlive:
+      if Stage.game.get_value_for_datastore(stage) != game_key:
+         # choice is from another game
          self.error(403)
          return
       
-      if choice not in stage.players:
+      if not alivestate.is_alive(stage, player.index) or \
+            not alivestate.is_alive(stage, choice.index):
          self.error(403)
          return
       
+      if not self.admit_game(game_key):
+         return
       
-      vote_game_player = next(p for p in vote.choices if p.player.user == user), None
+      if QUEUE_CASTS:
+         # folded into the player's VoteGamePlayer and the tally later
+         castqueue.append(vote_key, user, player_key, choice_key)
+      else:
+         # the tally moves from the choice the transaction replaced, so
+         # two quick casts never both move it away from the same one
+         old_choice = db.run_in_transaction(_cast, vote_key, user,
+                                            player_key, choice_key)
+         tally.move_vote(vote, old_choice, choice)
+      # casts leave the snapshot alone; its open votes' counts are read
+      # from the tally on every view (snapshots.get)
+      changes.bump(vote, game_key)
+
+def _cast(vote_key, user, player_key, choice_key):
+   """Records user's choice in a vote (run in a transaction)
+
+   Returns the choice it replaced, None on the player's first cast.
+   """
+   key = VoteGamePlayer.key_for(vote_key, user)
+   vote_game_player = db.get(key)
+   if vote_game_player:
+      old_choice = VoteGamePlayer.choice.get_value_for_datastore(
+         vote_game_player)
+   else:
       # player has not previously voted in this vote
-      if not vote_game_player:
-         vote_game_player = VoteGamePlayer()
-         vote_game_player.vote = vote
-         vote_game_player.player = stage_game_player.player
-      
-      vote_game_player.choice = choice
-      vote_game_player.put()
+      vote_game_player = VoteGamePlayer(key_name = key.name(),
+                                        vote = vote_key,
+                                        player = player_key)
+      old_choice = None
+   vote_game_player.choice = choice_key
+   vote_game_player.put()
+   return old_choice
+
+def _add_moderator(game_key, user):
+   """Makes user a moderator of the game (run in a transaction)
+
+   Creates the GameModerator and records user in Game.moderatorUsers,
+   both in the game's entity group.
+   """
+   key = GameModerator.key_for(game_key, user)
+   if not db.get(key):
+      GameModerator(parent=game_key, key_name=key.name(), user=user,
+                    game=game_key).put()
+   game = db.get(game_key)
+   if user not in game.moderatorUsers:
+      game.moderatorUsers.append(user)
+      game.put()
 
 class  AddModeratorAction(BaseRequestHandler):
    """ Post action to add a moderator to a game
@@ -626,24 +1004,153 @@ class  AddModeratorAction(BaseRequestHandler):
             email
             game
    """
-   @login_required
+   @action_login_required
+   @rate_limited
    def post(self):
-      game = self.request.get('game')
+      game = Game.get(self.request.get('game'))
       email = self.request.get('email')
       if not game or not email:
          self.error(403)
          return
 
-       # Validate this user has access to this task list
-      if not game.current_user_has_access():
+      # Validate this user moderates the game
+      if not game.current_user_moderating():
          self.error(403)
          return
+      
+      if not self.admit_game(game.key()):
+         return
 
       # Don't duplicate entries in the permissions datastore
       user = users.User(email)
       if not game.user_moderating(user):
-         moderator = GameModerator(user=user, game = game)
-         moderator.put()
+         db.run_in_transaction(_add_moderator, game.key(), user)
+         aclcache.invalidate(aclcache.MODERATOR, game, user)
       
       if self.request.get('next'):
          self.redirect(self.request.get('next'))
+
+
+class ChangesPage(BaseRequestHandler):
+   """ url: /changes?game=<gameid>[&vote=<voteid>]&version=<version>
+
+         Poll for live pages.  Answers at once whether the game's (and the
+         vote's, which must be in the game) version differs from the one
+         given, with how long to wait before polling again.
+
+         Response (JSON):
+            {"version": <version>, "changed": true|false,
+             "retry": <seconds>}
+   """
+   @login_required
+   def get(self):
+      game = Game.get(self.request.get('game'))
+      
+      if not game:
+         self.error(403)
+         return
+      
+      if not game.current_user_playing() and \
+            not game.current_user_moderating():
+         self.error(403)
+         return
+      
+      watched = [game.key()]
+      if self.request.get('vote'):
+         try:
+            vote_key = db.Key(self.request.get('vote'))
+         except (db.BadKeyError, db.BadArgumentError):
+            self.error(403)
+            return
+         vote = db.get(vote_key)
+         if not isinstance(vote, Vote):
+            self.error(403)
+            return
+         stage = db.get(Vote.stage.get_value_for_datastore(vote))
+         if Stage.game.get_value_for_datastore(stage) != game.key():
+            # vote is from another game
+            self.error(403)
+            return
+         watched.append(vote_key)
+      since = self.request.get('version')
+      
+      version = changes.token(*watched)
+      
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.headers['Cache-Control'] = 'no-cache'
+      self.response.out.write(simplejson.dumps({
+         'version': version,
+         'changed': version != since,
+         'retry': changes.RETRY_SECONDS,
+         }))
+
+class FeedPage(BaseRequestHandler):
+   """ url: /feed?game=<gameid>&token=<feed token>
+
+         Atom feed of the game's events (events.py).  The token (from the
+         play page) stands in for signing in, which feed readers cannot do.
+   """
+   def get(self):
+      try:
+         game_key = db.Key(self.request.get('game'))
+      except (db.BadKeyError, db.BadArgumentError):
+         self.error(403)
+         return
+      
+      if not events.check_feed_token(game_key, self.request.get('token')):
+         self.error(403)
+         return
+      
+      feed = events.render_feed(game_key, self.request)
+      if not feed:
+         self.error(403)
+         return
+      
+      etag, last_modified, body = feed
+      if conditional.not_modified(self, etag, last_modified):
+         return
+      self.response.headers['Content-Type'] = 'application/atom+xml'
+      self.response.out.write(body)
+
+class GameStateApi(BaseRequestHandler):
+   """ url: /api/game?game=<gameid>[&since=<version>]
+
+         The game's current state as JSON, for players and moderators
+         (gamestate.py).  With since (the version of an earlier response)
+         only what changed is sent.
+
+         Response (JSON):
+            {"version": <version>, "changed": false} if nothing changed, or
+            {"version", "changed": true, "game",
+             "roster": {"stage", "players": [{"key", "seat", "alias",
+                                               "alive"}]},
+             "votes": [{"key", "name", "index", "isOpen", "counts",
+                        "leaders", "cast"}]}
+            with roster and votes left out when unchanged
+   """
+   def get(self):
+      user = users.GetCurrentUser()
+      try:
+         game_key = db.Key(self.request.get('game'))
+      except (db.BadKeyError, db.BadArgumentError):
+         self.error(403)
+         return
+      
+      if not user or (not Game.get_player_key(game_key, user) and
+                       not Game.get_moderator_key(game_key, user)):
+         self.error(403)
+         return
+      
+      since = self.request.get('since')
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.headers['Cache-Control'] = 'no-cache'
+      if gamestate.unchanged(game_key, since):
+         self.response.out.write(simplejson.dumps({
+            'version': since,
+            'changed': False,
+            }))
+         return
+      
+      game = db.get(game_key)
+      self.response.out.write(simplejson.dumps(
+         gamestate.state(game, user, since)))
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+#
+# Datastore index and write-cost analyzer for VoteLynch.
+#
+# Reads the models in models.py and every query in the application's
+# modules (Model.all() and db.Query() chains, follow-up filter() and
+# order() calls on a query variable, back-references such as vote.choices
+# in modules and templates) without importing them, and reports:
+#
+#   - every query site and the composite index it needs, if any
+#   - per model, the properties that are filtered or sorted on and those
+#     that nothing queries, which are safe to mark indexed=False.
+#     ReferenceProperties are never listed: each has a back-reference
+#     (collection_name, or <model>_set by default), which would silently
+#     find nothing once the property is unindexed
+#   - per model, the index rows a put() writes, as declared and with the
+#     unqueried properties unindexed
+#
+# Queries it cannot read (a filter on a computed property name, e.g.
+# Game._user_games_page) are listed as such.  The manual indexes in the
+# current index.yaml that no readable query accounts for are kept, and
+# their properties count as queried; those that only restate what the
+# built-in indexes already serve are reported as unneeded.
+#
+# With --index-yaml, writes the minimal index.yaml: the composite indexes
+# the queries need, each commented with the functions whose queries need
+# it, plus the kept ones, followed by the AUTOGENERATED marker.
+#
+# Usage:
+#   python indexcost.py [--list-length 10] [--index-yaml index.yaml]
+#
+
+import glob
+import optparse
+import os
+import re
+import textwrap
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that are tools rather than part of the application
+SKIP_MODULES = ('benchmark.py', 'indexcost.py')
+
+# Cost of a put() in index rows (datastore write operations):
+#   new entity:       the entity and its by-kind row, plus an ascending and
+#                     a descending row per indexed property value and a row
+#                     per composite index value
+#   existing entity:  the entity, plus a delete and an add of both rows per
+#                     changed indexed property value and of the row per
+#                     composite index value
+NEW_PUT_WRITES = 2
+NEW_PUT_PER_VALUE = 2
+NEW_PUT_PER_COMPOSITE = 1
+UPDATE_WRITES = 1
+UPDATE_PER_VALUE = 4
+UPDATE_PER_COMPOSITE = 2
+
+# Property types that are never indexed
+UNINDEXED_TYPES = ('TextProperty', 'BlobProperty')
+
+# Property types holding a list; each element is an index value
+LIST_TYPES = ('ListProperty', 'StringListProperty')
+
+INEQUALITY_OPS = ('<', '<=', '>', '>=', '!=')
+
+MARKER = '# AUTOGENERATED'
+
+AUTOGENERATED_NOTE = """
+# This index.yaml is automatically updated whenever the dev_appserver
+# detects that a new type of query is run.  If you want to manage the
+# index.yaml file manually, remove the above marker line (the line
+# saying "# AUTOGENERATED").  If you want to manage some indexes
+# manually, move them above the marker line.  The index.yaml file is
+# automatically uploaded to the admin console when you next deploy
+# your application using appcfg.py.
+"""
+
+
+class Model(object):
+   def __init__(self, name):
+      self.name = name
+      self.properties = []    # Property, in declaration order
+      self.queried = {}       # property name -> [why]
+
+   def property(self, name):
+      for prop in self.properties:
+         if prop.name == name:
+            return prop
+      return None
+
+class Property(object):
+   def __init__(self, name, type, args):
+      self.name = name
+      self.type = type
+      self.indexed = type not in UNINDEXED_TYPES and \
+                     not re.search(r'indexed\s*=\s*False', args)
+      self.is_list = type in LIST_TYPES
+      self.collection = None
+      if type == 'ReferenceProperty':
+         match = re.search(r'collection_name\s*=\s*[\'"](\w+)', args)
+         if match:
+            self.collection = match.group(1)
+
+class Query(object):
+   def __init__(self, kind, site, where):
+      self.kind = kind        # model name, or None if computed
+      self.site = site        # 'module.py:line'
+      self.where = where      # 'module.Class.function', or a template
+      self.ancestor = False
+      self.equalities = []    # property names
+      self.inequalities = []  # property names
+      self.orders = []        # (property name, 'asc' or 'desc')
+      self.unreadable = []    # filter()/order() calls on computed names
+
+   def describe(self):
+      parts = []
+      if self.ancestor:
+         parts.append('ancestor')
+      parts.extend(['%s =' % name for name in self.equalities])
+      parts.extend(['%s <>' % name for name in self.inequalities])
+      parts.extend(['order %s%s' % ((direction == 'desc' and '-' or ''), name)
+                    for name, direction in self.orders])
+      parts.extend(['%s ?' % call for call in self.unreadable])
+      return '%s(%s)' % (self.kind or '<model>', ', '.join(parts))
+
+   def natural_index(self):
+      """Returns the (kind, ancestor, properties) index that serves it
+
+      properties: ((name, direction), ...), equality properties first, then
+      the inequality property, then the sort orders.
+      """
+      properties = []
+      for name in self.equalities:
+         if (name, 'asc') not in properties:
+            properties.append((name, 'asc'))
+      orders = list(self.orders)
+      if self.inequalities:
+         name = self.inequalities[0]
+         direction = 'asc'
+         if orders and orders[0][0] == name:
+            direction = orders.pop(0)[1]
+         properties.append((name, direction))
+      for order in orders:
+         if order not in properties:
+            properties.append(order)
+      return (self.kind, self.ancestor, tuple(properties))
+
+   def composite_index(self):
+      """Returns the composite index it needs, or None
+
+      The built-in indexes serve kind queries, queries with only equality
+      filters (and an ancestor), and queries that filter or sort on a
+      single property.  Results in key order need no index either.  A
+      query that is not fully readable gets none.
+      """
+      if self.unreadable:
+         return None
+      kind, ancestor, properties = self.natural_index()
+      if properties and properties[-1] == ('__key__', 'asc'):
+         properties = properties[:-1]
+      if not self.inequalities and \
+         len([o for o in self.orders if o != ('__key__', 'asc')]) == 0:
+         return None
+      if not ancestor and not self.equalities and len(properties) <= 1:
+         return None
+      return (kind, ancestor, properties)
+
+
+def read(path):
+   f = open(path)
+   try:
+      return f.read()
+   finally:
+      f.close()
+
+def _balanced(text, start):
+   """Returns the index just past the bracket that closes text[start]"""
+   depth = 0
+   for i in range(start, len(text)):
+      if text[i] in '([{':
+         depth += 1
+      elif text[i] in ')]}':
+         depth -= 1
+         if depth == 0:
+            return i + 1
+   return len(text)
+
+def read_models(source):
+   """Returns {model name: Model} declared in the source of models.py
+
+   A model declared twice (forward declarations) keeps its last body.
+   """
+   models = {}
+   current = None
+   for match in re.finditer(r'^class (\w+)\(db\.Model\):|'
+                            r'^   (\w+) = db\.(\w+Property)\(', source, re.M):
+      if match.group(1):
+         current = Model(match.group(1))
+         models[current.name] = current
+      elif current:
+         end = _balanced(source, match.end() - 1)
+         current.properties.append(Property(
+            match.group(2), match.group(3), source[match.end():end]))
+   return models
+
+
+_START = re.compile(r'\b(\w+)\.all\(|\bdb\.Query\((\w+)')
+_CALL = re.compile(r'\.(filter|order|ancestor)\(\s*(?:\'([^\']*)\'|"([^"]*)")?')
+
+def _logical_lines(source):
+   """Yields (first line number, indent, text) of each logical line"""
+   lines = source.split('\n')
+   i = 0
+   while i < len(lines):
+      first = i
+      text = lines[i]
+      depth = 0
+      while True:
+         depth += len(re.findall(r'[(\[{]', lines[i])) - \
+                  len(re.findall(r'[)\]}]', lines[i]))
+         if (depth > 0 or lines[i].rstrip().endswith('\\')) and \
+            i + 1 < len(lines):
+            i += 1
+            text = text + '\n' + lines[i]
+         else:
+            break
+      i += 1
+      indent = len(text) - len(text.lstrip())
+      yield first + 1, indent, text
+
+def _apply_calls(query, text):
+   for call in _CALL.finditer(text):
+      name, literal = call.group(1), call.group(2) or call.group(3)
+      if name == 'ancestor':
+         query.ancestor = True
+      elif literal is None:
+         query.unreadable.append(name)
+      elif name == 'order':
+         literal = literal.strip()
+         if literal.startswith('-'):
+            query.orders.append((literal[1:], 'desc'))
+         else:
+            query.orders.append((literal, 'asc'))
+      else:
+         parts = literal.split()
+         prop = parts[0]
+         op = len(parts) > 1 and parts[1] or '='
+         if op in INEQUALITY_OPS:
+            if prop not in query.inequalities:
+               query.inequalities.append(prop)
+         else:
+            query.equalities.append(prop)
+
+def read_queries(module, source, models):
+   """Returns the Query of every query built in a module's source"""
+   queries = []
+   logical = list(_logical_lines(source))
+   scopes = []       # (indent, name) of the enclosing classes and functions
+   for n, (line, indent, text) in enumerate(logical):
+      if text.strip():
+         while scopes and scopes[-1][0] >= indent:
+            scopes.pop()
+      scope = re.match(r'\s*(?:def|class)\s+(\w+)', text)
+      if scope:
+         scopes.append((indent, scope.group(1)))
+      where = '.'.join([module[:-len('.py')]] +
+                       [name for i, name in scopes])
+      starts = list(_START.finditer(text))
+      for i, match in enumerate(starts):
+         kind = match.group(1) or match.group(2)
+         if kind not in models:
+            kind = None
+         if i + 1 < len(starts):
+            chain = text[match.end():starts[i + 1].start()]
+         else:
+            chain = text[match.end():]
+         query = Query(kind, '%s:%d' % (module, line), where)
+         _apply_calls(query, chain)
+
+         # query = Model.all() followed by query.filter(...) statements
+         assigned = re.match(r'\s*(\w+)\s*=\s*$', text[:match.start()])
+         if assigned:
+            var = assigned.group(1)
+            for later_line, later_indent, later in logical[n + 1:]:
+               if later.strip() and later_indent < indent:
+                  break
+               for call in re.finditer(r'\b%s((?:\.(?:filter|order|ancestor)'
+                                       r'\([^\n]*)+)' % var, later):
+                  _apply_calls(query, call.group(1))
+         queries.append(query)
+   return queries
+
+def read_back_references(sources, models):
+   """Returns equality Queries for the back-references in use
+
+   sources: [(name, text)] of modules and templates
+   """
+   queries = []
+   for model in models.values():
+      for prop in model.properties:
+         if prop.type != 'ReferenceProperty':
+            continue
+         collection = prop.collection or '%s_set' % model.name.lower()
+         for name, text in sources:
+            for match in re.finditer(r'\.%s\b' % collection, text):
+               line = text.count('\n', 0, match.start()) + 1
+               query = Query(model.name, '%s:%d' % (name, line), name)
+               query.equalities.append(prop.name)
+               queries.append(query)
+   return queries
+
+
+def read_index_yaml(text):
+   """Returns the indexes above the AUTOGENERATED marker
+
+   [(kind, ancestor, ((name, direction), ...), comment)], where comment
+   is the comment block just above the index.
+   """
+   indexes = []
+   comment = []
+   current = None
+   for line in text.split(MARKER)[0].split('\n'):
+      stripped = line.strip()
+      if stripped.startswith('#'):
+         comment.append(stripped)
+      elif stripped.startswith('- kind:'):
+         current = [stripped.split(':', 1)[1].strip(), False, [], comment]
+         indexes.append(current)
+         comment = []
+      elif current and stripped.startswith('ancestor:'):
+         current[1] = stripped.split(':', 1)[1].strip() in ('yes', 'true')
+      elif current and stripped.startswith('- name:'):
+         current[2].append([stripped.split(':', 1)[1].strip(), 'asc'])
+      elif current and stripped.startswith('direction:'):
+         current[2][-1][1] = stripped.split(':', 1)[1].strip()
+   return [(kind, ancestor, tuple([tuple(p) for p in properties]), comment)
+           for kind, ancestor, properties, comment in indexes]
+
+def format_index(index, comment):
+   kind, ancestor, properties = index
+   lines = comment + ['- kind: %s' % kind]
+   if ancestor:
+      lines.append('  ancestor: yes')
+   lines.append('  properties:')
+   for name, direction in properties:
+      lines.append('  - name: %s' % name)
+      if direction == 'desc':
+         lines.append('    direction: desc')
+   return '\n'.join(lines)
+
+
+def analyze(list_length):
+   """Returns the analysis of the application as a dict"""
+   models = read_models(read(os.path.join(ROOT, 'models.py')))
+   modules = []
+   for path in sorted(glob.glob(os.path.join(ROOT, '*.py'))):
+      if os.path.basename(path) not in SKIP_MODULES:
+         modules.append((os.path.basename(path), read(path)))
+   templates = [('templates/' + os.path.basename(path), read(path))
+                for path in sorted(glob.glob(os.path.join(ROOT, 'templates',
+                                                          '*')))]
+
+   queries = []
+   for name, text in modules:
+      queries.extend(read_queries(name, text, models))
+   queries.extend(read_back_references(modules + templates, models))
+
+   def mark(kind, name, why):
+      targets = kind and [models[kind]] or models.values()
+      for model in targets:
+         if name == '__key__' or model.property(name) is None:
+            continue
+         model.queried.setdefault(name, []).append(why)
+
+   needed = {}       # composite index -> [queries]
+   builtin = {}      # natural index of a query needing none -> [sites]
+   for query in queries:
+      for name in query.equalities + query.inequalities + \
+                  [name for name, direction in query.orders]:
+         mark(query.kind, name, query.site)
+      composite = query.composite_index()
+      if composite:
+         needed.setdefault(composite, []).append(query)
+      elif query.kind:
+         builtin.setdefault(query.natural_index(), []).append(query.site)
+
+   kept = []
+   unneeded = []
+   yaml_path = os.path.join(ROOT, 'index.yaml')
+   if os.path.exists(yaml_path):
+      for kind, ancestor, properties, comment in read_index_yaml(
+            read(yaml_path)):
+         index = (kind, ancestor, properties)
+         if index in needed:
+            continue
+         if index in builtin:
+            unneeded.append((index, builtin[index]))
+            continue
+         kept.append((index, comment))
+         for name, direction in properties:
+            mark(kind, name, 'index.yaml')
+
+   costs = []
+   for model in sorted(models.values(), key=lambda m: m.name):
+      composites = [index for index in list(needed.keys()) + [i for i, c in kept]
+                    if index[0] == model.name]
+      costs.append(_costs(model, composites, list_length))
+
+   return {
+      'models': models,
+      'queries': queries,
+      'needed': needed,
+      'kept': kept,
+      'unneeded': unneeded,
+      'costs': costs,
+      }
+
+def _costs(model, composites, list_length):
+   def values(props):
+      return sum([p.is_list and list_length or 1 for p in props])
+   composite_values = 0
+   for kind, ancestor, properties in composites:
+      rows = 1
+      for name, direction in properties:
+         prop = model.property(name)
+         if prop and prop.is_list:
+            rows *= list_length
+      composite_values += rows
+
+   indexed = [p for p in model.properties if p.indexed]
+   queried = [p for p in indexed if p.name in model.queried]
+   # back-references need their ReferenceProperty indexed
+   required = [p for p in indexed if p.name in model.queried or
+               p.type == 'ReferenceProperty']
+   unqueried = [p for p in indexed if p not in required]
+
+   def new_put(props):
+      return NEW_PUT_WRITES + NEW_PUT_PER_VALUE * values(props) + \
+             NEW_PUT_PER_COMPOSITE * composite_values
+   return {
+      'model': model.name,
+      'indexed': [p.name for p in indexed],
+      'queried': [p.name for p in queried],
+      'unqueried': [p.name for p in unqueried],
+      'composites': composite_values,
+      'new_put': new_put(indexed),
+      'update': UPDATE_WRITES + UPDATE_PER_VALUE * values(indexed) +
+                UPDATE_PER_COMPOSITE * composite_values,
+      'new_put_unindexed': new_put(required),
+      }
+
+
+def report(analysis, list_length):
+   print('Query sites')
+   def site_order(query):
+      module, line = query.site.split(':')
+      return module, int(line)
+   for query in sorted(analysis['queries'], key=site_order):
+      composite = query.composite_index()
+      if query.unreadable:
+         note = 'not fully readable'
+      elif composite:
+         note = 'composite index'
+      else:
+         note = 'built-in indexes'
+      print('  %-22s %-50s %s' % (query.site, query.describe(), note))
+
+   print('')
+   print('Index writes per put() (list properties counted as %d values)'
+         % list_length)
+   print('  %-16s %8s %8s %8s %10s' % ('model', 'new', 'update',
+                                       'composite', 'unindexed'))
+   for cost in analysis['costs']:
+      print('  %-16s %8d %8d %8d %10d' % (cost['model'], cost['new_put'],
+            cost['update'], cost['composites'], cost['new_put_unindexed']))
+   print('  (unindexed: a new put() with the properties below indexed=False)')
+
+   print('')
+   print('Properties nothing filters or sorts on (safe to mark indexed=False)')
+   for cost in analysis['costs']:
+      if cost['unqueried']:
+         print('  %s: %s' % (cost['model'], ', '.join(cost['unqueried'])))
+
+   print('')
+   print('Manual indexes in index.yaml')
+   for index, comment in analysis['kept']:
+      print('  kept, no readable query accounts for it: %s'
+            % _index_name(index))
+   for index, sites in analysis['unneeded']:
+      print('  unneeded, the built-in indexes serve %s: %s'
+            % (', '.join(sites), _index_name(index)))
+   for index in sorted(analysis['needed'].keys()):
+      print('  needed by %s: %s' % (', '.join([query.site for query in
+                                               analysis['needed'][index]]),
+                                    _index_name(index)))
+
+def _index_name(index):
+   kind, ancestor, properties = index
+   names = [(direction == 'desc' and '-' or '') + name
+            for name, direction in properties]
+   if ancestor:
+      names.insert(0, 'ancestor')
+   return '%s(%s)' % (kind, ', '.join(names))
+
+def index_yaml(analysis):
+   """Returns the text of the minimal index.yaml"""
+   entries = []
+   for index in sorted(analysis['needed'].keys()):
+      users = []
+      for query in analysis['needed'][index]:
+         if query.where not in users:
+            users.append(query.where)
+      comment = ['# ' + line for line in
+                 textwrap.wrap('Needed by ' + ', '.join(users), 77)]
+      entries.append(format_index(index, comment))
+   for index, comment in analysis['kept']:
+      entries.append(format_index(index, comment))
+   return 'indexes:\n\n%s\n\n%s\n%s' % ('\n\n'.join(entries), MARKER,
+                                        AUTOGENERATED_NOTE)
+
+
+def main():
+   parser = optparse.OptionParser(usage='%prog [options]')
+   parser.add_option('--list-length', type='int', default=10,
+                     help='values assumed per list property (default 10)')
+   parser.add_option('--index-yaml', metavar='FILE',
+                     help='write the minimal index.yaml to FILE')
+   options, args = parser.parse_args()
+
+   analysis = analyze(options.list_length)
+   report(analysis, options.list_length)
+   if options.index_yaml:
+      f = open(options.index_yaml, 'w')
+      try:
+         f.write(index_yaml(analysis))
+      finally:
+         f.close()
+      print('')
+      print('Wrote %s' % options.index_yaml)
+
+if __name__ == '__main__':
+   main()
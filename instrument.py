@@ -0,0 +1,187 @@
+"""Per-request datastore and rendering instrumentation.
+
+InstrumentMiddleware wraps the WSGI application.  While a request runs,
+apiproxy hooks count and time every datastore call (gets, puts, queries,
+deletes) and, in DEBUG or for one request in CALL_SITE_SAMPLE, remember
+the application line that made it, and
+BaseRequestHandler reports its class name and template rendering time.
+Finished requests go into a rolling in-memory window of the last
+WINDOW_SIZE requests, and requests slower than SLOW_REQUEST_MS into a slow
+log with their busiest call sites.  Both are per instance; /admin/stats
+(admin.py) shows them.
+"""
+
+import os
+import random
+import sys
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+from settings import DEBUG
+
+
+# Requests kept for the aggregated stats
+WINDOW_SIZE = 1000
+
+# Requests slower than this go to the slow log, which keeps SLOW_LOG_SIZE
+SLOW_REQUEST_MS = 500
+SLOW_LOG_SIZE = 50
+
+# Outside DEBUG, call sites are recorded for one request in this many
+CALL_SITE_SAMPLE = 20
+
+# Datastore calls grouped as reported
+_CALL_KINDS = {
+   'Get': 'get',
+   'Put': 'put',
+   'Delete': 'delete',
+   'RunQuery': 'query',
+   'Next': 'query',
+   'Count': 'query',
+   }
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+window = []
+slow_log = []
+
+_current = None       # RequestRecord of the request in progress
+_call_starts = []     # start times of the datastore calls in progress
+_code_sites = {}      # code object -> (file name, function), None if not ours
+
+
+class RequestRecord(object):
+   """What one request spent its time on"""
+
+   def __init__(self, method, path):
+      self.method = method
+      self.path = path
+      self.handler = None
+      self.started = time.time()
+      self.elapsed_ms = 0
+      self.render_ms = 0
+      self.calls = {}        # kind -> [count, ms]
+      self.call_sites = {}   # 'file:line function' -> count
+      self.sample_sites = DEBUG or random.randrange(CALL_SITE_SAMPLE) == 0
+
+   def count(self, kind):
+      return self.calls.get(kind, [0, 0])[0]
+
+   def rpc_ms(self):
+      return sum([ms for count, ms in self.calls.values()])
+
+   def top_call_sites(self, limit=5):
+      sites = self.call_sites.items()
+      sites.sort(key=lambda site: -site[1])
+      return sites[:limit]
+
+
+def _code_site(code):
+   """Returns (file name, function) of application code, else None"""
+   if code not in _code_sites:
+      filename = os.path.abspath(code.co_filename)
+      if filename.startswith(_APP_DIR) and \
+            os.path.basename(filename) != 'instrument.py':
+         _code_sites[code] = (os.path.basename(filename), code.co_name)
+      else:
+         _code_sites[code] = None
+   return _code_sites[code]
+
+def _call_site():
+   """Returns the innermost application line in the current stack"""
+   frame = sys._getframe(1)
+   while frame:
+      site = _code_site(frame.f_code)
+      if site:
+         return '%s:%d %s' % (site[0], frame.f_lineno, site[1])
+      frame = frame.f_back
+   return 'unknown'
+
+def _pre_call(service, call, request, response):
+   if _current is None:
+      return
+   _call_starts.append(time.time())
+   if _current.sample_sites:
+      site = _call_site()
+      _current.call_sites[site] = _current.call_sites.get(site, 0) + 1
+
+def _post_call(service, call, request, response):
+   if _current is None or not _call_starts:
+      return
+   ms = (time.time() - _call_starts.pop()) * 1000
+   totals = _current.calls.setdefault(_CALL_KINDS.get(call, call), [0, 0])
+   totals[0] += 1
+   totals[1] += ms
+
+def install():
+   """Registers the datastore hooks (idempotent)"""
+   apiproxy = apiproxy_stub_map.apiproxy
+   apiproxy.GetPreCallHooks().Append('instrument', _pre_call, 'datastore_v3')
+   apiproxy.GetPostCallHooks().Append('instrument', _post_call,
+                                      'datastore_v3')
+
+
+def set_handler(name):
+   """Records which handler class serves the current request"""
+   if _current is not None:
+      _current.handler = name
+
+def record_render(seconds):
+   """Adds template rendering time to the current request"""
+   if _current is not None:
+      _current.render_ms += seconds * 1000
+
+def _finish(record):
+   record.elapsed_ms = (time.time() - record.started) * 1000
+   window.append(record)
+   del window[:-WINDOW_SIZE]
+   if record.elapsed_ms >= SLOW_REQUEST_MS:
+      slow_log.append(record)
+      del slow_log[:-SLOW_LOG_SIZE]
+
+
+class InstrumentMiddleware(object):
+   """WSGI middleware recording a RequestRecord for every request"""
+
+   def __init__(self, application):
+      self.application = application
+      install()
+
+   def __call__(self, environ, start_response):
+      global _current
+      _current = RequestRecord(environ.get('REQUEST_METHOD'),
+                               environ.get('PATH_INFO'))
+      del _call_starts[:]
+      try:
+         return self.application(environ, start_response)
+      finally:
+         _finish(_current)
+         _current = None
+
+
+def summary():
+   """Returns per-handler aggregates over the window, slowest first
+
+   Each entry is a dict with the handler name, request count and mean
+   milliseconds, datastore calls and rendering time per request.
+   """
+   groups = {}
+   for record in window:
+      groups.setdefault(record.handler or record.path, []).append(record)
+   rows = []
+   for name, records in groups.items():
+      n = float(len(records))
+      rows.append({
+         'handler': name,
+         'requests': len(records),
+         'mean_ms': sum([r.elapsed_ms for r in records]) / n,
+         'max_ms': max([r.elapsed_ms for r in records]),
+         'gets': sum([r.count('get') for r in records]) / n,
+         'puts': sum([r.count('put') for r in records]) / n,
+         'queries': sum([r.count('query') for r in records]) / n,
+         'rpc_ms': sum([r.rpc_ms() for r in records]) / n,
+         'render_ms': sum([r.render_ms for r in records]) / n,
+         })
+   rows.sort(key=lambda row: -row['mean_ms'])
+   return rows
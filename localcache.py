@@ -0,0 +1,76 @@
+"""In-process stand-in for the memcache API.
+
+LocalCache implements the subset of google.appengine.api.memcache used by
+this app (get, set, add, delete, incr) with per-entry expiry and
+least-recently-used eviction.  Swap it in for memcache when running
+outside the App Engine runtime, e.g. aclcache.use_backend(LocalCache()).
+"""
+
+import time
+
+
+class LocalCache(object):
+   """A bounded dict with memcache semantics"""
+   
+   def __init__(self, max_entries=1000, clock=time.time):
+      self.max_entries = max_entries
+      self.clock = clock
+      self._entries = {}      # key -> (value, expires or 0)
+      self._order = []        # keys, least recently used first
+   
+   def _touch(self, key):
+      if key in self._order:
+         self._order.remove(key)
+      self._order.append(key)
+   
+   def _lookup(self, key):
+      entry = self._entries.get(key)
+      if entry is None:
+         return None
+      if entry[1] and entry[1] <= self.clock():
+         self.delete(key)
+         return None
+      self._touch(key)
+      return entry
+   
+   def _store(self, key, value, time):
+      if time and time < 60*60*24*30:
+         time += self.clock()      # relative, as in memcache
+      self._entries[key] = (value, time)
+      self._touch(key)
+      while len(self._order) > self.max_entries:
+         del self._entries[self._order.pop(0)]
+   
+   def get(self, key):
+      entry = self._lookup(key)
+      return entry and entry[0]
+   
+   def set(self, key, value, time=0):
+      self._store(key, value, time)
+      return True
+   
+   def add(self, key, value, time=0):
+      if self._lookup(key):
+         return False
+      self._store(key, value, time)
+      return True
+   
+   def delete(self, key):
+      if key in self._entries:
+         del self._entries[key]
+         self._order.remove(key)
+         return 2
+      return 1
+   
+   def incr(self, key, delta=1):
+      entry = self._lookup(key)
+      if not entry:
+         return None
+      value = entry[0] + delta
+      self._entries[key] = (value, entry[1])
+      return value
+   
+   def flush_all(self):
+      self._entries = {}
+      self._order = []
+      return True
@@ -3,6 +3,21 @@ from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
+from django.utils import simplejson
+import zlib
+
+import aclcache
+
+
+def _key_string(value):
+   """Returns the string form of an entity's key (or of a key)"""
+   if isinstance(value, db.Model):
+      value = value.key()
+   return str(value)
+
+
+# Games per page in the dashboard lists (Game.get_user_games_*)
+DASHBOARD_PAGE_SIZE = 20
 
 
 # forward declarations (redefined later)
@@ -18,8 +33,10 @@ class Stage(db.Model):
    Properties
      index: 0,1,2,... ordered index of stage
      game: related game
+     updated: datetime the stage or its roster last changed
+     seats: players (by GamePlayer.index) taking part: seats 0..seats-1
+     alive: bitset of the seats alive in this stage (see alivestate.py)
 
-     players: implicit - list of players in stage (StageGamePlayer)
      votes: implicit - list of votes in the stage (Vote)
    """
    
@@ -27,6 +44,9 @@ class Stage(db.Model):
    isDay = db.BooleanProperty()
    game = db.ReferenceProperty(Game, collection_name="stages")
    currentVote = db.ReferenceProperty(Vote)
+   updated = db.DateTimeProperty(auto_now=True)
+   seats = db.IntegerProperty(default=0)
+   alive = db.BlobProperty()
 
 class Game(db.Model):
    """Storage for a game
@@ -39,6 +59,10 @@ class Game(db.Model):
       published: Game is in play
       archived: Game over
       currentStage: current stage
+      playerCount: number of seats handed out (next GamePlayer.index)
+      playerUsers: users who joined (copy of GamePlayer.user, for queries)
+      moderatorUsers: moderators (copy of GameModerator.user, for queries)
+      feedSecret: token of the game's feed URL (events.feed_token)
 
       players: implicit - List of players participating
       stages: implicit - List of stages(days&nights)
@@ -52,30 +76,59 @@ class Game(db.Model):
    archived = db.BooleanProperty(default=False)
    published = db.BooleanProperty(default=False)
    locked = db.BooleanProperty(default=False)
+   playerCount = db.IntegerProperty(default=0)
+   playerUsers = db.ListProperty(users.User)
+   moderatorUsers = db.ListProperty(users.User)
+   feedSecret = db.StringProperty(indexed=False)
    
    @staticmethod
-   def get_current_user_games_moderating():
-      """Returns the games that the current user has moderator access"""
-      return Game.get_user_games_moderating(users.GetCurrentUser())
+   def get_current_user_games_moderating(archived=False, cursor=None):
+      """Returns a page of the games that the current user has moderator access"""
+      return Game.get_user_games_moderating(users.GetCurrentUser(),
+                                            archived, cursor)
    
    @staticmethod
-   def get_user_games_moderating(user):
-      """Returns the games that the given user has moderator access"""
-      if not user: return []
-      moderating = db.Query(GameModerator).filter('user =', user)
-      return [m.game for m in moderating]
+   def get_user_games_moderating(user, archived=False, cursor=None):
+      """Returns a page of the games that the given user has moderator access
+
+      See _user_games_page.
+      """
+      if not user: return [], None
+      return Game._user_games_page('moderatorUsers', user, archived, cursor)
    
    @staticmethod
-   def get_current_user_games_playing():
-      """Returns the games that the current user has joined"""
-      return Game.get_user_games_playing(users.GetCurrentUser())
+   def get_current_user_games_playing(archived=False, cursor=None):
+      """Returns a page of the games that the current user has joined"""
+      return Game.get_user_games_playing(users.GetCurrentUser(),
+                                         archived, cursor)
+   
+   @staticmethod
+   def get_user_games_playing(user, archived=False, cursor=None):
+      """Returns a page of the games that the given user has joined
+
+      See _user_games_page.
+      """
+      if not user: return [], None
+      return Game._user_games_page('playerUsers', user, archived, cursor)
    
    @staticmethod
-   def get_user_games_playing(user):
-      """Returns the games that the given user has joined"""
-      if not user: return []
-      playing = db.Query(GamePlayer).filter('user =', user)
-      return [p.game for p in playing]
+   def _user_games_page(users_property, user, archived, cursor):
+      """Returns (games, next cursor) for a dashboard list
+
+      Games are most recently updated first, DASHBOARD_PAGE_SIZE at a time,
+      archived ones only if archived is true.  The next cursor is None on
+      the last page.  Served by the composite indexes in index.yaml.
+      """
+      query = Game.all().filter(users_property + ' =', user)
+      if not archived:
+         query.filter('archived =', False)
+      query.order('-updated')
+      if cursor:
+         query.with_cursor(cursor)
+      games = query.fetch(DASHBOARD_PAGE_SIZE)
+      if len(games) < DASHBOARD_PAGE_SIZE:
+         return games, None
+      return games, query.cursor()
    
    def current_user_moderating(self):
       """Returns true if the current user has moderator access to this game."""
@@ -84,10 +137,7 @@ class Game(db.Model):
    def user_moderating(self, user):
       """Returns true if the given user has moderator acces to this game."""
       if not user: return False
-      query = db.Query(GameModerator)
-      query.filter('game =', self)
-      query.filter('user =', user)
-      return query.get()
+      return bool(Game.get_moderator_key(self, user))
    
    def current_user_playing(self):
       """Returns true if the current user has joined this game"""
@@ -97,27 +147,70 @@ class Game(db.Model):
       """Returns true if the given user has joined this game"""
       if not user:
          return False
-      query = db.Query(GamePlayer)
-      query.filter('game =', self)
-      query.filter('user =', user)
-      return query.get()
+      return bool(Game.get_player_key(self, user))
+   
+   @staticmethod
+   def get_player_key(game, user):
+      """Returns the key of user's GamePlayer in game (entity or key)
+
+      Returns None if the user has not joined.  Cached in aclcache.
+      """
+      return aclcache.member_key(aclcache.PLAYER, game, user,
+                                 lambda: _member_key(GamePlayer, game, user))
+   
+   @staticmethod
+   def get_moderator_key(game, user):
+      """Returns the key of user's GameModerator in game (entity or key)
+
+      Returns None if the user does not moderate it.  Cached in aclcache.
+      """
+      return aclcache.member_key(aclcache.MODERATOR, game, user,
+                                 lambda: _member_key(GameModerator, game, user))
+
+def _member_key(model, game, user):
+   """Looks up the key of user's membership entity (of model) in game
+
+   A get by the derived key; rows created before membership keys were
+   derived are found by a query until /tasks/rekeymembers has re-keyed
+   them.
+   """
+   key = model.key_for(game, user)
+   if db.get(key):
+      return key
+   query = model.all(keys_only=True)
+   query.filter('game =', game)
+   query.filter('user =', user)
+   return query.get()
 
 class GamePlayer(db.Model):
    """Represents the many-to-many relationship between Games and Users
 
-   Game Player ACL
+   Game Player ACL.  A child of its game with the user's email as key name
+   (see key_for), so a membership check is a get and a user can only join
+   a game once.
 
    Properties
      user: related user
      game: related game
+     alias: name the player chose when joining
+     index: seat number, 0,1,2,... in joining order; stable for the whole
+            game and used to index Stage.alive
    """
    user = db.UserProperty(required=True)
    game = db.ReferenceProperty(Game, required=True)
+   alias = db.StringProperty()
+   index = db.IntegerProperty()
+   
+   @staticmethod
+   def key_for(game, user):
+      """Returns the key of user's GamePlayer in game (entity or key)"""
+      return db.Key.from_path('GamePlayer', user.email(),
+                              parent = db.Key(_key_string(game)))
 
 class GameModerator(db.Model):
    """Represents the many-to-nany relationship between Games and Users
 
-   Game Moderator ACL
+   Game Moderator ACL.  Keyed like GamePlayer (see key_for).
 
    Properties
      user: related user
@@ -125,10 +218,19 @@ class GameModerator(db.Model):
    """
    user = db.UserProperty(required=True)
    game = db.ReferenceProperty(Game,required=True)
+   
+   @staticmethod
+   def key_for(game, user):
+      """Returns the key of user's GameModerator in game (entity or key)"""
+      return db.Key.from_path('GameModerator', user.email(),
+                              parent = db.Key(_key_string(game)))
 
 class StageGamePlayer(db.Model):
    """Represents the many-to-many relationship between Stages and GamePlayers
 
+   Legacy: a stage's roster is now Stage.seats/Stage.alive.  Existing rows
+   are only read by alivestate.migrate_stage, which then deletes them.
+
    Properties
         player: related player
         stage: related stage
@@ -146,8 +248,10 @@ class Vote(db.Model):
     Properties
         day: related day(stage)
 
-        StageGamePlayers: indirect - players in stage (get from Stage)
+        players: indirect - seats in the stage (Stage.seats, Stage.alive)
 
+        method, tieBreak: how the vote is decided (see resolution.py)
+        outcome, winner, resolved: the decision, recorded on close
    """
    name = db.StringProperty()
    created = db.DateTimeProperty(auto_now_add=True)
@@ -158,10 +262,170 @@ class Vote(db.Model):
    
    stage = db.ReferenceProperty(Stage, collection_name="votes")
    index = db.IntegerProperty()
+   
+   method = db.StringProperty(default='plurality',
+                              choices=('plurality', 'majority'))
+   tieBreak = db.StringProperty(default='nolynch',
+                                choices=('nolynch', 'random'))
+   outcome = db.StringProperty()
+   winner = db.ReferenceProperty(GamePlayer, collection_name='votes_won')
+   resolved = db.DateTimeProperty()
 
 class VoteGamePlayer(db.Model):
    """Represents the many-to-many relationship between Votes and Players
+
+   Key name is '<vote key>/<user email>' (see key_name_for) so casting a
+   vote is a get and a put by key.
+
+   sequence is the number of the last queued cast folded into the row
+   (castqueue.fold), None if it was only ever cast directly.
    """
-   choice = db.ReferenceProperty(StageGamePlayer)
+   choice = db.ReferenceProperty(GamePlayer,
+                                 collection_name = 'votes_received')
    player = db.ReferenceProperty(GamePlayer)
    vote = db.ReferenceProperty(Vote, collection_name = 'choices')
+   sequence = db.IntegerProperty(indexed=False)
+   
+   @staticmethod
+   def key_name_for(vote, user):
+      """Returns the key name of the given user's choice in vote"""
+      return '%s/%s' % (_key_string(vote), user.email())
+   
+   @staticmethod
+   def key_for(vote, user):
+      """Returns the key of the given user's choice in vote"""
+      return db.Key.from_path('VoteGamePlayer',
+                              VoteGamePlayer.key_name_for(vote, user))
+
+class QueuedCast(db.Model):
+   """A cast waiting to be folded into its VoteGamePlayer (see castqueue.py)
+
+   A child of one of the vote's log roots (castqueue.log_roots).
+
+   Properties
+     vote: the vote cast in
+     user: who cast it (names the VoteGamePlayer it folds into)
+     player, choice: the caster's and the chosen GamePlayer
+     sequence: arrival order, from the vote's cast counter
+   """
+   vote = db.ReferenceProperty(Vote, collection_name = 'queued_casts')
+   user = db.UserProperty(required=True)
+   player = db.ReferenceProperty(GamePlayer,
+                                 collection_name = 'queued_casts')
+   choice = db.ReferenceProperty(GamePlayer,
+                                 collection_name = 'queued_choices')
+   sequence = db.IntegerProperty(required=True)
+
+class CastFoldLease(db.Model):
+   """Marks a fold of a vote's queued casts in progress (see castqueue.py)
+
+   A child of the vote with key name 'fold'; claimed and released in
+   transactions.
+
+   Properties
+     owner: random id of the fold holding the lease
+     expires: when another fold may take the lease over
+   """
+   owner = db.StringProperty(required=True, indexed=False)
+   expires = db.DateTimeProperty(required=True, indexed=False)
+   
+   @staticmethod
+   def key_for(vote):
+      """Returns the key of a vote's lease"""
+      return db.Key.from_path('CastFoldLease', 'fold',
+                              parent = db.Key(_key_string(vote)))
+
+class VoteTallyShard(db.Model):
+   """One shard of the running tally for a Vote (see tally.py)
+
+   Shards are root entities with key name '<vote key>:<n>' so every shard
+   is its own entity group and casts on different shards never contend.
+
+   Properties
+     candidates: GamePlayer keys counted in this shard
+     counts: count for each candidate, parallel to candidates.  A single
+             shard may hold negative counts; only the sum over all shards
+             of a vote is meaningful.
+     Neither is queried, so neither is indexed.
+   """
+   candidates = db.ListProperty(db.Key, indexed=False)
+   counts = db.ListProperty(int, indexed=False)
+
+class StageSnapshot(db.Model):
+   """Denormalized state of a Stage for the play page (see snapshots.py)
+
+   Key name is the stage's key.
+
+   Properties
+     schema: layout of data; snapshots with another schema are rebuilt
+     version: when the snapshot was built (milliseconds); keys the page
+              fragments cached from it
+     data: JSON encoded state (rosters, votes and leaders)
+   """
+   schema = db.IntegerProperty(required=True)
+   version = db.IntegerProperty()
+   data = db.TextProperty()
+   
+   def state(self):
+      """Returns the decoded snapshot data"""
+      return simplejson.loads(self.data)
+
+class VoteResult(db.Model):
+   """Frozen outcome of a closed Vote (see resolution.py)
+
+   Key name is the vote's key.  Written once when the vote closes (and
+   deleted only if it is reopened); closed votes are shown from it alone.
+
+   Properties
+     game: the vote's game
+     schema: layout of data
+     data: JSON encoded result: outcome, winner (GamePlayer key), counts
+           (GamePlayer key -> votes), choices (voter's GamePlayer key ->
+           chosen GamePlayer key) and the alive and dead rosters
+   """
+   game = db.ReferenceProperty(Game, collection_name = 'vote_results')
+   schema = db.IntegerProperty(required=True)
+   data = db.TextProperty()
+   
+   def result(self):
+      """Returns the decoded result"""
+      return simplejson.loads(self.data)
+   
+   @staticmethod
+   def key_for(vote):
+      """Returns the key of the result of vote (entity, key or string)"""
+      return db.Key.from_path('VoteResult', _key_string(vote))
+
+class GameArchive(db.Model):
+   """Full history of an archived game in one entity (see archive.py)
+
+   Key name is the game's key.  Once written, the game's stages, votes,
+   choices, tallies and snapshots are deleted.
+
+   Properties
+     schema: layout of data
+     data: zlib compressed JSON history
+     created: datetime the archive was written
+   """
+   schema = db.IntegerProperty(required=True)
+   data = db.BlobProperty()
+   created = db.DateTimeProperty(auto_now_add=True)
+   
+   def history(self):
+      """Returns the decoded history"""
+      return simplejson.loads(zlib.decompress(self.data))
+
+class GameEvent(db.Model):
+   """One entry of a game's activity feed (see events.py)
+
+   Events are children of their Game and never change, so the feed is one
+   ancestor query ordered by created.
+
+   Properties
+     kind: what happened (events.STAGE, DEATH, ...)
+     text: one line description
+     created: datetime of the event
+   """
+   kind = db.StringProperty(required=True)
+   text = db.StringProperty(required=True)
+   created = db.DateTimeProperty(auto_now_add=True)
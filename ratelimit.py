@@ -0,0 +1,90 @@
+"""Token bucket admission control for the POST actions (*.do).
+
+Each action route has two buckets per caller: one per user, and one per
+game the action targets.  A request takes one token from each bucket, and
+a bucket refills continuously at its rate up to its burst size.  The
+user's bucket is checked first (check_user(), before the action touches
+the datastore), so a client that exhausts its own bucket is turned away
+before it spends the game's.  The game's bucket is checked once the
+action has loaded its entities (check_game()), keyed by the game they
+belong to rather than by anything the client sends.  Creating a game
+only has the user's bucket.
+
+Buckets live in memcache (or a stand-in, see use_backend()).  They are
+read and written without a lock, so concurrent requests can occasionally
+take the same token; that slack is fine for admission control.
+"""
+
+import math
+import time
+
+from google.appengine.api import memcache
+
+
+# route -> (per user, per game) limits, each (tokens per second, burst)
+DEFAULT_LIMITS = ((1.0, 10), (10.0, 100))
+LIMITS = {
+   # every player may change their mind often, but not in a loop
+   '/castvote.do': ((0.5, 10), (20.0, 200)),
+   # each attempt checks a password
+   '/joingame.do': ((0.1, 5), (1.0, 30)),
+   '/addmoderator.do': ((0.1, 5), (0.5, 10)),
+   '/creategame.do': ((0.02, 5), (0.02, 5)),
+   }
+
+_backend = memcache
+
+
+def use_backend(backend):
+   """Replaces memcache, e.g. with localcache.LocalCache"""
+   global _backend
+   _backend = backend
+
+def _wait(key, rate, burst, now):
+   """Seconds until the bucket at key has a token, 0 if it has one now"""
+   state = _backend.get(key)
+   if state is None:
+      return 0
+   tokens, stamp = state
+   tokens = min(burst, tokens + (now - stamp) * rate)
+   if tokens >= 1:
+      return 0
+   return (1 - tokens) / rate
+
+def _take(key, rate, burst, now):
+   state = _backend.get(key)
+   if state is None:
+      tokens = burst
+   else:
+      tokens, stamp = state
+      tokens = min(burst, tokens + (now - stamp) * rate)
+   # a bucket left alone for burst / rate seconds is full again, which is
+   # what a missing entry means
+   _backend.set(key, (tokens - 1, now), time=int(burst / rate) + 1)
+
+def _check(key, limit):
+   """Takes a token from the bucket at key, if it has one
+
+   Returns 0 if it did.  Otherwise returns the (whole) number of seconds
+   after which it would, and takes nothing.
+   """
+   now = time.time()
+   rate, burst = limit
+   wait = _wait(key, rate, burst, now)
+   if wait:
+      return int(math.ceil(wait))
+   _take(key, rate, burst, now)
+   return 0
+
+def check_user(route, user):
+   """Admits or refuses one request to route by user (see _check)"""
+   return _check('ratelimit:%s:user:%s' % (route, user.email()),
+                 LIMITS.get(route, DEFAULT_LIMITS)[0])
+
+def check_game(route, game_key):
+   """Admits or refuses one request to route against a game (see _check)
+
+   game_key: the key of the game the action's entities belong to.
+   """
+   return _check('ratelimit:%s:game:%s' % (route, game_key),
+                 LIMITS.get(route, DEFAULT_LIMITS)[1])
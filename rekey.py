@@ -0,0 +1,107 @@
+"""Migration of GamePlayer and GameModerator rows to derived keys.
+
+Rows created before memberships were keyed by (game, user) have
+auto-generated ids.  rekey_step() moves one game over, one step per task
+(RekeyMembersTask):
+
+  step 0:  copies every legacy player to its derived key (see
+           GamePlayer.key_for) and re-keys the moderators, which nothing
+           refers to, outright
+  1..n:    rewrites the references of stage n-1 (VoteGamePlayer player
+           and choice, Vote.winner, VoteResult data), folds queued casts
+           first and recounts the tallies and the snapshot
+  last:    deletes the legacy players and drops their cached keys
+
+Tallies are recounted, so run it while the game is idle.  A user who had
+joined twice keeps the row with the lower seat.
+"""
+
+from google.appengine.ext import db
+
+import aclcache
+import castqueue
+import changes
+import snapshots
+import tally
+from models import GameModerator, GamePlayer, Stage, Vote, VoteGamePlayer
+from models import VoteResult
+
+
+def _legacy_players(game_key):
+   """Returns the game's GamePlayers that still have generated ids, by seat"""
+   players = [p for p in GamePlayer.all().filter('game =', game_key)
+              if p.key().parent() is None]
+   players.sort(key=lambda p: (p.index is None, p.index))
+   return players
+
+def _rekey_moderators(game_key):
+   legacy = [m for m in GameModerator.all().filter('game =', game_key)
+             if m.key().parent() is None]
+   db.put([GameModerator(parent = game_key, key_name = m.user.email(),
+                         user = m.user, game = game_key) for m in legacy])
+   db.delete(legacy)
+   for moderator in legacy:
+      aclcache.invalidate(aclcache.MODERATOR, game_key, moderator.user)
+
+def _copy_players(game_key, legacy):
+   existing = set([p.key() for p in db.get(
+      [GamePlayer.key_for(game_key, p.user) for p in legacy]) if p])
+   copies = {}
+   for player in legacy:
+      key = GamePlayer.key_for(game_key, player.user)
+      if key in copies or key in existing:
+         continue
+      copies[key] = GamePlayer(parent = game_key, key_name = key.name(),
+                               user = player.user, game = game_key,
+                               alias = player.alias, index = player.index)
+   db.put(copies.values())
+
+def _rekey_stage(stage, mapping):
+   for vote in Vote.all().filter('stage =', stage):
+      castqueue.drain(vote.key())
+      rows = list(VoteGamePlayer.all().filter('vote =', vote))
+      for row in rows:
+         for prop in (VoteGamePlayer.player, VoteGamePlayer.choice):
+            old = prop.get_value_for_datastore(row)
+            if old in mapping:
+               prop.__set__(row, mapping[old])
+      changed = list(rows)
+      winner = Vote.winner.get_value_for_datastore(vote)
+      if winner in mapping:
+         vote.winner = mapping[winner]
+         changed.append(vote)
+      result = VoteResult.get(VoteResult.key_for(vote))
+      if result:
+         data = result.data
+         for old, new in mapping.items():
+            data = data.replace(str(old), str(new))
+         result.data = data
+         changed.append(result)
+      db.put(changed)
+      tally.rebuild(vote, rows)
+   snapshots.rebuild(stage)
+
+def rekey_step(game_key, step):
+   """Runs one step of re-keying a game's memberships
+
+   Returns the next step, or None when the game is done.
+   """
+   legacy = _legacy_players(game_key)
+   mapping = dict([(p.key(), GamePlayer.key_for(game_key, p.user))
+                   for p in legacy])
+   if step == 0:
+      _rekey_moderators(game_key)
+      _copy_players(game_key, legacy)
+      return 1
+
+   stage = Stage.all().filter('game =', game_key) \
+                .filter('index =', step - 1).get()
+   if stage:
+      _rekey_stage(stage, mapping)
+      return step + 1
+
+   db.delete(legacy)
+   for player in legacy:
+      aclcache.invalidate(aclcache.PLAYER, game_key, player.user)
+   changes.bump(game_key)
+   return None
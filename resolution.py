@@ -0,0 +1,200 @@
+"""Vote resolution and whole-game voting analytics.
+
+resolve() decides a Vote from its VoteGamePlayer choices (read by key)
+when it closes, records the decision on the vote (Vote.outcome, winner,
+resolved) and freezes the counts, every voter's choice and the stage's
+rosters into a VoteResult, from which closed votes are shown.  Only
+choices by and for seats alive in the vote's stage count.
+
+  plurality: the candidate with the most votes is lynched
+  majority:  the leader must have more than half the votes of the living
+
+A tie for the lead is settled by the vote's tie break: 'nolynch' lynches
+nobody, 'random' draws one of the leaders (seeded by the vote's key, so
+resolving again gives the same answer).
+
+analyze() computes voting statistics over a game's whole history in one
+pass.  It works on the history layout of archive.serialize(), so live and
+archived games (archive.history()) are analyzed the same way.  The python
+runtime has no numpy, so the "arrays" are lists of lists indexed by seat.
+"""
+
+import datetime
+import random
+
+from google.appengine.ext import db
+from django.utils import simplejson
+
+import alivestate
+from models import Stage, VoteGamePlayer, VoteResult
+
+
+# Bump whenever the layout of VoteResult.data changes
+RESULT_SCHEMA = 1
+
+PLURALITY = 'plurality'
+MAJORITY = 'majority'
+
+TIE_NO_LYNCH = 'nolynch'
+TIE_RANDOM = 'random'
+
+# Vote.outcome values
+LYNCH = 'lynch'
+TIE = 'tie'
+NO_MAJORITY = 'nomajority'
+NO_VOTES = 'novotes'
+
+# Pairs of players who voted alike at least this often, over at least
+# BLOC_MIN_SHARED votes, are reported as a bloc
+BLOC_AGREEMENT = 0.75
+BLOC_MIN_SHARED = 2
+
+
+def count(choices, alive):
+   """Returns {candidate seat: votes} for (voter seat, choice seat) pairs
+
+   Pairs whose voter or choice is not in the alive set are ignored.
+   """
+   counts = {}
+   for voter, choice in choices:
+      if voter in alive and choice in alive:
+         counts[choice] = counts.get(choice, 0) + 1
+   return counts
+
+def decide(counts, electorate, method=PLURALITY, tie_break=TIE_NO_LYNCH,
+           seed=None):
+   """Returns (outcome, winning seat or None) for a count
+
+   electorate is the number of players who could vote.
+   """
+   if not counts:
+      return NO_VOTES, None
+   top = max(counts.values())
+   if method == MAJORITY and top * 2 <= electorate:
+      return NO_MAJORITY, None
+   leaders = sorted([seat for seat, votes in counts.items() if votes == top])
+   if len(leaders) == 1:
+      return LYNCH, leaders[0]
+   if tie_break == TIE_RANDOM:
+      return LYNCH, random.Random(seed).choice(leaders)
+   return TIE, None
+
+def stored_rows(vote, players):
+   """Returns the VoteGamePlayer rows of a vote, one per voter
+
+   players: the game's GamePlayers.  Every player's row is read by key, as
+   a query could still miss the rows castqueue.drain() has just written.
+   Rows from before their keys were derived are never written again, so a
+   query finds them all; a keyed row of the same voter is newer and wins.
+   """
+   rows = {}      # voter's GamePlayer key -> row
+   legacy = [row for row in VoteGamePlayer.all().filter('vote =', vote)
+             if row.key().name() is None]
+   keyed = [row for row in db.get([VoteGamePlayer.key_for(vote, p.user)
+                                   for p in players]) if row]
+   for row in legacy + keyed:
+      voter = VoteGamePlayer.player.get_value_for_datastore(row)
+      if voter:
+         rows[voter] = row
+   return rows.values()
+
+def resolve(vote, players=None):
+   """Decides vote and returns its frozen VoteResult
+
+   The decision is also recorded on vote (outcome, winner, resolved).
+   Neither entity is put; the caller stores both, e.g. db.put([vote,
+   result]).  players: the game's GamePlayers, if the caller already has
+   them.
+   """
+   stage = vote.stage
+   game_key = Stage.game.get_value_for_datastore(stage)
+   if players is None:
+      players = alivestate.game_players(game_key)
+   seat_of = dict([(p.key(), p.index) for p in players])
+   by_seat = dict([(p.index, p) for p in players])
+
+   choices = {}      # voter's GamePlayer key -> chosen GamePlayer key
+   for row in stored_rows(vote, players):
+      choice = VoteGamePlayer.choice.get_value_for_datastore(row)
+      if choice:
+         choices[VoteGamePlayer.player.get_value_for_datastore(row)] = choice
+   alive = alivestate.alive_seats(stage)
+
+   counts = count([(seat_of.get(voter), seat_of.get(choice))
+                   for voter, choice in choices.items()], alive)
+   outcome, seat = decide(counts, len(alive), vote.method, vote.tieBreak,
+                          str(vote.key()))
+   vote.outcome = outcome
+   vote.winner = by_seat.get(seat)
+   vote.resolved = datetime.datetime.now()
+
+   alive_players, dead_players = alivestate.roster(stage, players)
+   return VoteResult(
+      key_name = str(vote.key()),
+      game = game_key,
+      schema = RESULT_SCHEMA,
+      data = simplejson.dumps({
+         'outcome': outcome,
+         'winner': vote.winner and str(vote.winner.key()),
+         'counts': dict([(str(by_seat[s].key()), n)
+                         for s, n in counts.items()]),
+         'choices': dict([(str(voter), str(choice))
+                          for voter, choice in choices.items()]),
+         'alive': [alivestate.player_entry(p) for p in alive_players],
+         'dead': [alivestate.player_entry(p) for p in dead_players],
+         }))
+
+
+def analyze(history):
+   """Returns voting statistics for a game history (archive.serialize())
+
+   The result is a JSON-able dict over the game's seats:
+     players: the history's players
+     matrix: matrix[voter][target] is how often voter chose target
+     cast, received: votes cast and received by each seat
+     agreement: agreement[a][b] is the fraction of the votes both a and b
+                took part in where they chose alike (None if none)
+     blocs: [a, b, agreement, shared] for pairs voting alike at least
+            BLOC_AGREEMENT of the time, most alike first
+   """
+   size = max([p['seat'] for p in history['players']] + [-1]) + 1
+   matrix = [[0] * size for _ in range(size)]
+   shared = [[0] * size for _ in range(size)]
+   agreed = [[0] * size for _ in range(size)]
+
+   for stage in history['stages']:
+      for vote in stage['votes']:
+         ballot = [(voter, choice) for voter, choice in vote['choices']
+                   if voter is not None and choice is not None]
+         for voter, choice in ballot:
+            matrix[voter][choice] += 1
+         for i in range(len(ballot)):
+            a, a_choice = ballot[i]
+            for b, b_choice in ballot[i + 1:]:
+               shared[a][b] += 1
+               shared[b][a] += 1
+               if a_choice == b_choice:
+                  agreed[a][b] += 1
+                  agreed[b][a] += 1
+
+   agreement = [[None] * size for _ in range(size)]
+   blocs = []
+   for a in range(size):
+      for b in range(size):
+         if not shared[a][b]:
+            continue
+         agreement[a][b] = float(agreed[a][b]) / shared[a][b]
+         if a < b and shared[a][b] >= BLOC_MIN_SHARED and \
+               agreement[a][b] >= BLOC_AGREEMENT:
+            blocs.append([a, b, agreement[a][b], shared[a][b]])
+   blocs.sort(key=lambda bloc: (-bloc[2], -bloc[3]))
+
+   return {
+      'players': history['players'],
+      'matrix': matrix,
+      'cast': [sum(row) for row in matrix],
+      'received': [sum([row[seat] for row in matrix])
+                   for seat in range(size)],
+      'agreement': agreement,
+      'blocs': blocs,
+      }
@@ -0,0 +1,15 @@
+"""Application-wide settings.
+
+Kept apart from votelynch.py so that handler modules can read them without
+importing the main script.
+"""
+
+# Set to true if we want to have our webapp print stack traces, etc
+DEBUG = True
+
+# Salt value for password hash value generation
+MMSALT = "a8b8d8e8t8g"
+
+# Queue casts and fold them into the stored choices in the background
+# (castqueue.py) rather than writing them while the player waits
+QUEUE_CASTS = True
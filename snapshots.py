@@ -0,0 +1,120 @@
+"""Per-stage snapshots of game state.
+
+A StageSnapshot holds everything the play page and /api/game show for a
+stage: the live and dead rosters with aliases, the stage's votes and the
+counts and current leaders of each.  Handlers that change a stage's roster
+or votes call rebuild(); reads go through get(), which rebuilds a snapshot
+only if it is missing or has an old schema.
+
+The stage's votes are found with a query, which may not yet see a vote
+written a moment ago, so handlers that create, open or close a vote pass
+it to rebuild() themselves.
+
+Casts do not touch the snapshot.  A closed vote's counts are stored from
+its frozen VoteResult; an open vote's are read from the live tally
+(tally.get_counts) by get() on every read, so a surge of casts costs each
+page view one batch get of tally shards per open vote rather than a
+rebuild.
+"""
+
+import time
+
+from google.appengine.ext import db
+from django.utils import simplejson
+
+import alivestate
+import tally
+from models import Stage, StageSnapshot, Vote, VoteResult
+
+
+# Bump whenever the layout of the snapshot data changes
+SNAPSHOT_SCHEMA = 2
+
+
+def rebuild(stage, written=()):
+   """Builds and stores the snapshot of a stage (entity or key)
+
+   written: Vote entities of the stage the caller has just put; they
+   replace whatever the query of the stage's votes returns for them.
+   """
+   if not isinstance(stage, Stage):
+      stage = db.get(stage)
+   alive_players, dead_players = alivestate.roster(stage)
+   alive = [alivestate.player_entry(p) for p in alive_players]
+   dead = [alivestate.player_entry(p) for p in dead_players]
+   aliases = dict([(db.Key(e['key']), e['alias']) for e in alive + dead])
+   
+   stage_votes = dict([(vote.key(), vote) for vote in
+                       Vote.all().filter('stage =', stage)])
+   for vote in written:
+      stage_votes[vote.key()] = vote
+   stage_votes = stage_votes.values()
+   stage_votes.sort(key=lambda vote: vote.index)
+   # closed votes count from their frozen results, in one batch get
+   closed = [vote for vote in stage_votes if not vote.isOpen]
+   results = dict(zip([vote.key() for vote in closed],
+                      db.get([VoteResult.key_for(vote) for vote in closed])))
+   
+   votes = []
+   for vote in stage_votes:
+      entry = {
+         'key': str(vote.key()),
+         'name': vote.name,
+         'index': vote.index,
+         'isOpen': vote.isOpen,
+         }
+      if results.get(vote.key()):
+         _set_counts(entry, dict([(db.Key(k), n) for k, n in
+            results[vote.key()].result()['counts'].items()]), aliases)
+      else:
+         # filled in from the live tally by get()
+         _set_counts(entry, {}, aliases)
+      votes.append(entry)
+   
+   data = {
+      'stage': {
+         'key': str(stage.key()),
+         'index': stage.index,
+         'isDay': stage.isDay,
+         },
+      'alive': alive,
+      'dead': dead,
+      'votes': votes,
+      }
+   snapshot = StageSnapshot(key_name = str(stage.key()),
+                            schema = SNAPSHOT_SCHEMA,
+                            version = int(time.time() * 1000),
+                            data = simplejson.dumps(data))
+   snapshot.put()
+   return snapshot
+
+def _set_counts(entry, counts, aliases):
+   """Sets a vote entry's counts, leaders and leading count
+
+   counts: {GamePlayer key: votes}.  aliases: {GamePlayer key: alias}.
+   """
+   top = counts and max(counts.values()) or 0
+   entry['leaders'] = [{'key': str(k), 'alias': aliases.get(k, '')}
+                       for k, n in counts.items() if n == top]
+   entry['count'] = top
+   entry['counts'] = dict([(str(k), n) for k, n in counts.items()])
+
+def is_stale(snapshot):
+   """Returns true if snapshot needs rebuilding"""
+   return not snapshot or snapshot.schema != SNAPSHOT_SCHEMA
+
+def get(game_key, stage_key):
+   """Returns (snapshot, state dict) for a stage, repairing stale snapshots
+
+   The state's open votes carry their live counts.
+   """
+   snapshot = StageSnapshot.get_by_key_name(str(stage_key))
+   if is_stale(snapshot):
+      snapshot = rebuild(stage_key)
+   state = snapshot.state()
+   aliases = dict([(db.Key(e['key']), e['alias'])
+                   for e in state['alive'] + state['dead']])
+   for entry in state['votes']:
+      if entry['isOpen']:
+         _set_counts(entry, tally.get_counts(entry['key']), aliases)
+   return snapshot, state
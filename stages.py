@@ -0,0 +1,55 @@
+"""Stage rollover.
+
+A new stage takes over the previous stage's seats and alive bitset (see
+alivestate.py), or seats every player alive for the first stage, so
+starting a stage is a single entity write however many players there are.
+The game's currentStage pointer is then switched in a transaction.
+"""
+
+from google.appengine.ext import db
+
+import alivestate
+import changes
+import events
+from models import Game, Stage
+
+
+def create_next_stage(game):
+   """Creates the stage following the game's current stage and makes it
+   the game's current stage
+
+   Returns the new Stage.  If a concurrent rollover won, the stage created
+   here is deleted and the game's current stage is returned instead.
+   """
+   previous_key = Game.currentStage.get_value_for_datastore(game)
+   if previous_key:
+      previous = db.get(previous_key)
+      stage = Stage(index = previous.index + 1, isDay = not previous.isDay,
+                    game = game, seats = previous.seats,
+                    alive = previous.alive)
+   else:
+      seats = game.playerCount or 0
+      stage = Stage(index = 0, isDay = True, game = game, seats = seats,
+                    alive = alivestate.encode(range(seats)))
+   stage.put()
+   
+   if not db.run_in_transaction(_make_current, game.key(), stage.key(),
+                                previous_key):
+      # the winning rollover has made and announced its own stage
+      stage.delete()
+      return db.get(game.key()).currentStage
+   changes.bump(game)
+   events.stage_started(game.key(), stage)
+   return stage
+
+def _make_current(game_key, stage_key, previous_key):
+   """Points the game at its new stage (run in a transaction)
+
+   Does nothing if another rollover got there first.
+   """
+   game = db.get(game_key)
+   if Game.currentStage.get_value_for_datastore(game) != previous_key:
+      return False
+   game.currentStage = stage_key
+   game.put()
+   return True
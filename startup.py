@@ -0,0 +1,52 @@
+"""Cold start helpers: timed imports and lazily imported handlers.
+
+votelynch.py imports the application's modules through timed_import() so
+the cost of a cold start can be broken down per module (see report()).
+Modules are imported in dependency order, so each entry is the time that
+module added on top of those before it.
+"""
+
+import logging
+import time
+
+
+started = time.time()
+
+# (module name, seconds to import) in import order
+import_times = []
+
+
+def timed_import(name):
+   """Imports and returns the named module, recording how long it took"""
+   start = time.time()
+   module = __import__(name)
+   import_times.append((name, time.time() - start))
+   return module
+
+def lazy_handler(module_name, class_name):
+   """Returns a handler factory that imports its module on first request
+
+   Used in the WSGIApplication route table in place of a handler class for
+   routes whose modules most instances never need.  The class is looked up
+   once and kept, so only the first request records an import time.
+   """
+   resolved = []
+   def factory():
+      if not resolved:
+         resolved.append(getattr(timed_import(module_name), class_name))
+      return resolved[0]()
+   factory.__name__ = class_name
+   return factory
+
+def report():
+   """Returns the cold start breakdown as a list of lines"""
+   lines = ['%-16s %7.1f ms' % (name, seconds * 1000)
+            for name, seconds in import_times]
+   lines.append('%-16s %7.1f ms' % ('total imports',
+                sum([seconds for name, seconds in import_times]) * 1000))
+   lines.append('%-16s %7.1f ms' % ('since start',
+                (time.time() - started) * 1000))
+   return lines
+
+def log_report():
+   logging.info('Startup cost:\n' + '\n'.join(report()))
@@ -0,0 +1,32 @@
+// Live page updates: polls /changes and reloads the page once the
+// game (or vote) it shows has changed.  See changes.py.
+
+function watchChanges(game, vote, version) {
+  var url = "/changes?game=" + encodeURIComponent(game);
+  if (vote) {
+    url += "&vote=" + encodeURIComponent(vote);
+  }
+
+  function poll() {
+    var xhr = window.XMLHttpRequest ? new XMLHttpRequest()
+                                    : new ActiveXObject("Microsoft.XMLHTTP");
+    xhr.open("GET", url + "&version=" + encodeURIComponent(version), true);
+    xhr.onreadystatechange = function() {
+      if (xhr.readyState != 4) return;
+      if (xhr.status == 200) {
+        var result = eval("(" + xhr.responseText + ")");
+        if (result.changed) {
+          window.location.reload();
+          return;
+        }
+        window.setTimeout(poll, result.retry * 1000);
+      } else {
+        // Back off on errors rather than hammering the server
+        window.setTimeout(poll, 30000);
+      }
+    };
+    xhr.send(null);
+  }
+
+  poll();
+}
@@ -0,0 +1,111 @@
+"""Sharded, incrementally maintained vote tallies.
+
+Every Vote spreads its per-candidate counts over NUM_SHARDS VoteTallyShard
+entities.  Casting or changing a vote updates one randomly picked shard in
+a transaction, so a burst of casts just before a vote closes is spread over
+NUM_SHARDS entity groups instead of piling onto one.  Reading the tally is
+a single batch get of the shards, however many players the game has.
+"""
+
+import random
+
+from google.appengine.ext import db
+
+from models import VoteGamePlayer, VoteTallyShard
+
+
+# Number of shards per vote.  Raise this if casts start failing with
+# TransactionFailedError under load; existing tallies keep working since
+# missing shards simply read as empty.
+NUM_SHARDS = 20
+
+
+def _key(value):
+   """Returns the datastore key for an entity, key or key string."""
+   if value is None:
+      return None
+   if isinstance(value, db.Model):
+      return value.key()
+   if isinstance(value, db.Key):
+      return value
+   return db.Key(value)
+
+def _shard_key_names(vote):
+   vote_key = str(_key(vote))
+   return ['%s:%d' % (vote_key, i) for i in range(NUM_SHARDS)]
+
+def shard_keys(vote):
+   """Returns the keys of every tally shard a vote may have"""
+   return [db.Key.from_path('VoteTallyShard', k)
+           for k in _shard_key_names(vote)]
+
+def _add(shard, candidate, amount):
+   """Adds amount to candidate's count in the given shard."""
+   if candidate in shard.candidates:
+      i = shard.candidates.index(candidate)
+      shard.counts[i] += amount
+   else:
+      shard.candidates.append(candidate)
+      shard.counts.append(amount)
+
+def get_counts(vote):
+   """Returns a dict mapping GamePlayer keys to their number of votes
+
+   Candidates with no votes are left out.
+   """
+   totals = {}
+   for shard in VoteTallyShard.get_by_key_name(_shard_key_names(vote)):
+      if not shard:
+         continue
+      for candidate, count in zip(shard.candidates, shard.counts):
+         totals[candidate] = totals.get(candidate, 0) + count
+   return dict([(c, n) for c, n in totals.items() if n])
+
+def move_vote(vote, old_choice, new_choice):
+   """Moves one vote from old_choice to new_choice
+
+   Either choice may be None (first cast, or a withdrawn vote).  Both counts
+   are changed on the same shard in one transaction so the tally is never
+   seen with the vote counted twice or not at all.
+   """
+   move_votes(vote, [(old_choice, new_choice)])
+
+def move_votes(vote, moves):
+   """Applies many (old_choice, new_choice) moves in one transaction
+
+   All moves go to the same randomly picked shard, so a batch of casts
+   costs one shard write.
+   """
+   moves = [(_key(old), _key(new)) for old, new in moves]
+   moves = [(old, new) for old, new in moves if old != new]
+   if not moves:
+      return
+   key_name = random.choice(_shard_key_names(vote))
+   def txn():
+      shard = VoteTallyShard.get_by_key_name(key_name)
+      if not shard:
+         shard = VoteTallyShard(key_name=key_name)
+      for old_choice, new_choice in moves:
+         if old_choice:
+            _add(shard, old_choice, -1)
+         if new_choice:
+            _add(shard, new_choice, 1)
+      shard.put()
+   db.run_in_transaction(txn)
+
+def rebuild(vote, choices):
+   """Replaces the tally of a vote with a recount of the given choices
+
+   choices: iterable of VoteGamePlayer.  Used to repair a tally or to seed
+   one for a vote that was cast before tallies existed.  Casts made while
+   the recount runs may be lost, so only rebuild closed votes.
+   """
+   totals = {}
+   for vote_game_player in choices:
+      choice = VoteGamePlayer.choice.get_value_for_datastore(vote_game_player)
+      if choice:
+         totals[choice] = totals.get(choice, 0) + 1
+   db.delete(shard_keys(vote)[1:])
+   VoteTallyShard(key_name=_shard_key_names(vote)[0],
+                  candidates=list(totals.keys()),
+                  counts=list(totals.values())).put()
@@ -0,0 +1,146 @@
+"""Task queue handlers (routes under /tasks/, admin only in app.yaml).
+
+Imported lazily by votelynch.py, since only task requests need it.
+"""
+
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+
+import alivestate
+import archive
+import castqueue
+import rekey
+from models import Game, GameModerator, GamePlayer
+
+
+# Batches of casts a /tasks/foldcasts task folds before queueing another
+FOLD_BATCHES_PER_TASK = 10
+
+
+class MigrateAliveStateTask(webapp.RequestHandler):
+   """ url: /tasks/migratealive
+
+         Converts games from per-stage StageGamePlayer rows to seats and
+         alive bitsets, one stage per step.  Without a game, queues a
+         migration for every game.
+
+         Post fields:
+            game (optional)
+            stage (index of the stage to migrate next, default 0)
+   """
+   def post(self):
+      if not self.request.get('game'):
+         for game_key in Game.all(keys_only=True):
+            taskqueue.add(url='/tasks/migratealive',
+                          params={'game': str(game_key)})
+         return
+      
+      game_key = db.Key(self.request.get('game'))
+      next_index = alivestate.migrate_stage(
+         game_key, int(self.request.get('stage') or 0))
+      if next_index is not None:
+         taskqueue.add(url='/tasks/migratealive',
+                       params={'game': str(game_key),
+                               'stage': next_index})
+
+
+class BackfillMemberUsersTask(webapp.RequestHandler):
+   """ url: /tasks/backfillmembers
+
+         Fills Game.playerUsers and Game.moderatorUsers, which the dashboard
+         queries on, from the GamePlayer and GameModerator rows of games
+         created before those lists existed.  Without a game, queues a
+         backfill for every game.
+
+         Post fields:
+            game (optional)
+   """
+   def post(self):
+      if not self.request.get('game'):
+         for game_key in Game.all(keys_only=True):
+            taskqueue.add(url='/tasks/backfillmembers',
+                          params={'game': str(game_key)})
+         return
+      
+      game_key = db.Key(self.request.get('game'))
+      players = [p.user for p in GamePlayer.all().filter('game =', game_key)]
+      moderators = [m.user for m in
+                    GameModerator.all().filter('game =', game_key)]
+      db.run_in_transaction(_set_member_users, game_key, players, moderators)
+
+def _set_member_users(game_key, players, moderators):
+   game = db.get(game_key)
+   for user in players:
+      if user not in game.playerUsers:
+         game.playerUsers.append(user)
+   for user in moderators:
+      if user not in game.moderatorUsers:
+         game.moderatorUsers.append(user)
+   game.put()
+
+
+class CompactGameTask(webapp.RequestHandler):
+   """ url: /tasks/compactgame
+
+         Moves an archived game into cold storage (archive.compact), one
+         step per task.
+
+         Post fields:
+            game
+   """
+   def post(self):
+      game_key = db.Key(self.request.get('game'))
+      if archive.compact(game_key):
+         taskqueue.add(url='/tasks/compactgame',
+                       params={'game': str(game_key)})
+
+
+class FoldCastsTask(webapp.RequestHandler):
+   """ url: /tasks/foldcasts
+
+         Folds a vote's queued casts into its VoteGamePlayer rows and tally
+         (castqueue.fold), up to FOLD_BATCHES_PER_TASK batches per task.
+
+         Post fields:
+            vote
+   """
+   def post(self):
+      vote_key = db.Key(self.request.get('vote'))
+      for i in range(FOLD_BATCHES_PER_TASK):
+         folded = castqueue.fold(vote_key)
+         if folded is None:
+            # another fold holds the vote; come back after it, in case it
+            # looked before the casts that queued this task
+            taskqueue.add(url='/tasks/foldcasts',
+                          params={'vote': str(vote_key)},
+                          countdown=castqueue.FOLD_DELAY_SECONDS)
+            return
+         if folded < castqueue.FOLD_BATCH:
+            return
+      taskqueue.add(url='/tasks/foldcasts', params={'vote': str(vote_key)})
+
+
+class RekeyMembersTask(webapp.RequestHandler):
+   """ url: /tasks/rekeymembers
+
+         Moves a game's GamePlayer and GameModerator rows to keys derived
+         from (game, user), one step per task (rekey.rekey_step).  Without
+         a game, queues the migration of every game.
+
+         Post fields:
+            game (optional)
+            step (default 0)
+   """
+   def post(self):
+      if not self.request.get('game'):
+         for game_key in Game.all(keys_only=True):
+            taskqueue.add(url='/tasks/rekeymembers',
+                          params={'game': str(game_key)})
+         return
+      
+      game_key = db.Key(self.request.get('game'))
+      step = rekey.rekey_step(game_key, int(self.request.get('step') or 0))
+      if step is not None:
+         taskqueue.add(url='/tasks/rekeymembers',
+                       params={'game': str(game_key), 'step': step})
@@ -0,0 +1,77 @@
+"""Compiled template cache and lazy template values.
+
+Templates are compiled once per instance and kept until the template file's
+modification time changes.  A change to a parent template ({% extends %})
+is only picked up once the child is recompiled, which in practice means on
+the next deploy or dev_appserver restart.
+"""
+
+import os
+
+import django.template
+from google.appengine.ext.webapp import template
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+_compiled = {}    # template name -> (mtime, compiled template)
+
+
+def get(template_name, debug=False):
+   """Returns the compiled template with the given name"""
+   path = os.path.join(TEMPLATE_DIR, template_name)
+   mtime = os.path.getmtime(path)
+   cached = _compiled.get(template_name)
+   if cached and cached[0] == mtime:
+      return cached[1]
+   compiled = template.load(path, debug)
+   _compiled[template_name] = (mtime, compiled)
+   return compiled
+
+def render(template_name, values, debug=False):
+   """Renders the named template with a dict of values"""
+   return get(template_name, debug).render(django.template.Context(values))
+
+def preload(debug=False):
+   """Compiles every template up front"""
+   for name in os.listdir(TEMPLATE_DIR):
+      if name.endswith('.html') or name.endswith('.xml'):
+         get(name, debug)
+
+
+class Lazy(object):
+   """A template value computed on first use
+
+   Lazy(func, *args) calls func(*args) only if the template actually prints,
+   tests, indexes or iterates the value, so values only some templates use
+   (or that a cached fragment makes unnecessary) cost nothing otherwise.
+   """
+   
+   def __init__(self, func, *args):
+      self._func = func
+      self._args = args
+   
+   def value(self):
+      if self._func:
+         self._value = self._func(*self._args)
+         self._func = None
+      return self._value
+   
+   def __str__(self):
+      return str(self.value())
+   
+   def __unicode__(self):
+      return u'%s' % self.value()
+   
+   def __nonzero__(self):
+      return bool(self.value())
+   __bool__ = __nonzero__
+   
+   def __len__(self):
+      return len(self.value())
+   
+   def __iter__(self):
+      return iter(self.value())
+   
+   def __getitem__(self, key):
+      return self.value()[key]
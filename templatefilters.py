@@ -19,11 +19,18 @@
 __author__ = 'Bret Taylor'
 
 import datetime
+import hashlib
 import time
 
+import django.template
+from google.appengine.api import memcache
 from google.appengine.ext.webapp import template
 
 
+# How long a {% cachefragment %} block stays cached
+FRAGMENT_CACHE_SECONDS = 60*60
+
+
 def rfc3339date(date):
   """Formats the given date in RFC 3339 format for feeds."""
   if not date: return ''
@@ -33,6 +40,44 @@ def rfc3339date(date):
   return date.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
+class CacheFragmentNode(django.template.Node):
+  def __init__(self, name, vary_on, nodelist):
+    self.name = name
+    self.vary_on = vary_on
+    self.nodelist = nodelist
+
+  def render(self, context):
+    parts = [self.name]
+    for variable in self.vary_on:
+      parts.append(u'%s' % django.template.resolve_variable(variable, context))
+    key = 'fragment:' + hashlib.md5(
+        u'|'.join(parts).encode('utf-8')).hexdigest()
+    rendered = memcache.get(key)
+    if rendered is None:
+      rendered = self.nodelist.render(context)
+      memcache.set(key, rendered, FRAGMENT_CACHE_SECONDS)
+    return rendered
+
+
+def cachefragment(parser, token):
+  """Caches the rendered contents of the block in memcache.
+
+  {% cachefragment "roster" stage.key stage.updated %} ... {% endcachefragment %}
+
+  The cache key is the name plus the values of the listed variables, so list
+  whatever identifies the block's data, typically entity keys and their
+  'updated' timestamps.
+  """
+  bits = token.split_contents()
+  if len(bits) < 2:
+    raise django.template.TemplateSyntaxError(
+        "'cachefragment' tag requires a name")
+  nodelist = parser.parse(('endcachefragment',))
+  parser.delete_first_token()
+  return CacheFragmentNode(bits[1].strip('"\''), bits[2:], nodelist)
+
+
 # Register the filter functions with Django
 register = template.create_template_register()
 register.filter(rfc3339date)
+register.tag(cachefragment)
@@ -15,55 +15,71 @@
 # limitations under the License.
 #
 
-import datetime
-import os
-import random
-import string
-import sys
-import wsgiref.handlers
+import startup
 
-from google.appengine.api import users
-from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
-from google.appengine.ext.webapp.util import login_required
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+import instrument
+import settings
 
 # Add our custom Django template filters to the built in filters
 template.register_template_library('templatefilters')
 
-# Set to true if we want to have our webapp print stack traces, etc
-_DEBUG = True
-
-# Salt value for password hash value generation
-MMSALT = "a8b8d8e8t8g"
+# Import the application's modules in dependency order, timing each one
+for name in ('models', 'tally', 'aclcache', 'changes', 'ratelimit',
+             'alivestate', 'resolution', 'castqueue', 'templatecache',
+             'events', 'stages', 'snapshots', 'gamestate', 'handlers'):
+   startup.timed_import(name)
 
-#import from external py files
 from handlers import *
-from models import *
+
+# Built once per instance; App Engine reuses this module (and so the
+# route table) for every request the instance serves.  InstrumentMiddleware
+# records each request's datastore calls and timings for /admin/stats.
+application = instrument.InstrumentMiddleware(webapp.WSGIApplication([
+   ('/', MainPage),
+   ('/creategame', CreateGamePage),
+   ('/creategame.do', CreateGameAction),
+   ('/managegame', ManageGamePage),
+   ('/createstage.do', CreateStageAction),
+   ('/managestage', ManageStagePage),
+   ('/managestage.do', ManageStageAction),
+   ('/killplayer.do', KillPlayerAction),
+   ('/reviveplayer.do', RevivePlayerAction),
+   ('/createvote.do', CreateVoteAction),
+   ('/managevote', ManageVotePage),
+   ('/openvote.do', OpenVoteAction),
+   ('/closevote.do', CloseVoteAction),
+   ('/join', JoinGamePage),
+   ('/joingame.do', JoinGameAction),
+   ('/play', PlayGamePage),
+   ('/vote', VotePage),
+   ('/castvote.do', CastVoteAction),
+   ('/addmoderator.do', AddModeratorAction),
+   ('/changes', ChangesPage),
+   ('/tasks/migratealive',
+      startup.lazy_handler('tasks', 'MigrateAliveStateTask')),
+   ('/archivegame.do',
+      startup.lazy_handler('archivepages', 'ArchiveGameAction')),
+   ('/history', startup.lazy_handler('archivepages', 'HistoryPage')),
+   ('/analytics', startup.lazy_handler('archivepages', 'AnalyticsPage')),
+   ('/export', startup.lazy_handler('archivepages', 'ExportPage')),
+   ('/feed', FeedPage),
+   ('/api/game', GameStateApi),
+   ('/tasks/compactgame', startup.lazy_handler('tasks', 'CompactGameTask')),
+   ('/tasks/backfillmembers',
+      startup.lazy_handler('tasks', 'BackfillMemberUsersTask')),
+   ('/tasks/rekeymembers',
+      startup.lazy_handler('tasks', 'RekeyMembersTask')),
+   ('/tasks/foldcasts', startup.lazy_handler('tasks', 'FoldCastsTask')),
+   ('/_ah/warmup', startup.lazy_handler('warmup', 'WarmupHandler')),
+   ('/admin/stats', startup.lazy_handler('admin', 'StatsPage')),
+   ], debug=settings.DEBUG))
 
 def main():
-   application = webapp.WSGIApplication([
-      ('/', MainPage),
-      ('/creategame', CreateGamePage),
-      ('/creategame.do', CreateGameAction),
-      ('/managegame', ManageGamePage),
-      ('/createstage.do', CreateStageAction),
-      ('/managestage', ManageStagePage),
-      ('/managestage.do', ManageStageAction),
-      ('/killplayer.do', KillPlayerAction),
-      ('/reviveplayer.do', RevivePlayerAction),
-      ('/createvote.do', CreateVoteAction),
-      ('/managevote', ManageVotePage),
-      ('/openvote.do', OpenVoteAction),
-      ('/closevote.do', CloseVoteAction),
-      ('/join', JoinGamePage),
-      ('/joingame.do', JoinGameAction),
-      ('/play', PlayGamePage),
-      ('/vote', VotePage),
-      ('/castvote.do', CastVoteAction),
-      ('/addmoderator.do', AddModeratorAction),
-      ], debug=_DEBUG)
-   wsgiref.handlers.CGIHandler().run(application)
+   run_wsgi_app(application)
 
 if __name__ == "__main__":
    main()
@@ -0,0 +1,26 @@
+"""Warmup request handler (/_ah/warmup).
+
+App Engine sends a warmup request to a new instance before routing user
+traffic to it.  Loading the remaining modules and compiling every template
+here keeps that cost off the first real request.
+"""
+
+from google.appengine.ext import webapp
+
+import settings
+import startup
+import templatecache
+
+
+class WarmupHandler(webapp.RequestHandler):
+   """ url: /_ah/warmup
+
+         Preloads modules and templates and reports the startup cost
+   """
+   def get(self):
+      for name in ('tasks', 'archivepages'):
+         startup.timed_import(name)
+      templatecache.preload(settings.DEBUG)
+      startup.log_report()
+      self.response.headers['Content-Type'] = 'text/plain'
+      self.response.out.write('\n'.join(startup.report()) + '\n')